@@ -8,5 +8,89 @@ class Settings:
     GEMINI_API_KEY: str = os.getenv("GEMINI_API_KEY")
     BASE_DIR: str = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
     STATIC_DIR: str = os.path.join(BASE_DIR, "static")
+    # Prefix of the URLs handed to clients
+    PUBLIC_BASE_URL: str = os.getenv("PUBLIC_BASE_URL", "http://localhost:8000").rstrip("/")
+    # SQLite database and Chroma stores live here
+    DATA_DIR: str = os.getenv("DATA_DIR", BASE_DIR)
+
+    # SQLite connection pool
+    DB_POOL_SIZE: int = int(os.getenv("DB_POOL_SIZE", "10"))
+    DB_MAX_OVERFLOW: int = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+    DB_BUSY_TIMEOUT_MS: int = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+
+    # Gemini call limits
+    GEMINI_MAX_CONCURRENCY: int = int(os.getenv("GEMINI_MAX_CONCURRENCY", "8"))
+    GEMINI_TIMEOUT_SECONDS: float = float(os.getenv("GEMINI_TIMEOUT_SECONDS", "30"))
+    GEMINI_MAX_RETRIES: int = int(os.getenv("GEMINI_MAX_RETRIES", "3"))
+    GEMINI_RETRY_BACKOFF_SECONDS: float = float(os.getenv("GEMINI_RETRY_BACKOFF_SECONDS", "0.5"))
+
+    # Chat history vector store, split into this many collections by session hash
+    HISTORY_SHARDS: int = int(os.getenv("HISTORY_SHARDS", "16"))
+
+    # Prompt context assembly
+    CONTEXT_TOKEN_BUDGET: int = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1500"))
+    CONTEXT_RECENT_TURNS: int = int(os.getenv("CONTEXT_RECENT_TURNS", "3"))
+    CONTEXT_SEMANTIC_TOP_K: int = int(os.getenv("CONTEXT_SEMANTIC_TOP_K", "3"))
+    # Number of messages older than the recent window that triggers a summary update
+    SUMMARY_TRIGGER_MESSAGES: int = int(os.getenv("SUMMARY_TRIGGER_MESSAGES", "12"))
+
+    # Avatar matching
+    AVATAR_MATCH_THRESHOLD: float = float(os.getenv("AVATAR_MATCH_THRESHOLD", "1.2"))
+    # Per-category overrides, keyed by the category of the stored avatar: "neutral:1.4,angry:0.9"
+    AVATAR_MATCH_THRESHOLDS: dict = {
+        category.strip().lower(): float(threshold)
+        for category, threshold in (pair.split(":") for pair in os.getenv("AVATAR_MATCH_THRESHOLDS", "").split(",") if pair.strip())
+    }
+    # Stored avatars considered per lookup, and how much shared wording between the two
+    # descriptions shrinks a candidate's distance when they are reranked (0 ranks by distance only)
+    AVATAR_MATCH_TOP_K: int = int(os.getenv("AVATAR_MATCH_TOP_K", "5"))
+    AVATAR_RERANK_WORD_WEIGHT: float = float(os.getenv("AVATAR_RERANK_WORD_WEIGHT", "0.25"))
+    # Log every reuse/generate decision with its distances, for tuning the thresholds
+    AVATAR_LOG_DECISIONS: bool = os.getenv("AVATAR_LOG_DECISIONS", "false").lower() in ("1", "true", "yes")
+    AVATAR_CACHE_SIZE: int = int(os.getenv("AVATAR_CACHE_SIZE", "4096"))
+    # Descriptions closer than this (squared L2) share one in-flight generation
+    AVATAR_COALESCE_THRESHOLD: float = float(os.getenv("AVATAR_COALESCE_THRESHOLD", "0.35"))
+
+    # Generated avatar assets
+    AVATAR_WEBP_QUALITY: int = int(os.getenv("AVATAR_WEBP_QUALITY", "80"))
+    AVATAR_THUMB_SIZE: int = int(os.getenv("AVATAR_THUMB_SIZE", "64"))
+    # Unreferenced generated avatars older than the min age are deleted every interval (0 disables)
+    AVATAR_GC_INTERVAL_SECONDS: float = float(os.getenv("AVATAR_GC_INTERVAL_SECONDS", "3600"))
+    AVATAR_GC_MIN_AGE_SECONDS: float = float(os.getenv("AVATAR_GC_MIN_AGE_SECONDS", "3600"))
+
+    # Avatar generation queue
+    AVATAR_WORKERS: int = int(os.getenv("AVATAR_WORKERS", "2"))
+    AVATAR_QUEUE_MAX: int = int(os.getenv("AVATAR_QUEUE_MAX", "100"))
+    AVATAR_JOB_MAX_ATTEMPTS: int = int(os.getenv("AVATAR_JOB_MAX_ATTEMPTS", "3"))
+    AVATAR_JOB_RETRY_SECONDS: float = float(os.getenv("AVATAR_JOB_RETRY_SECONDS", "2"))
+    # Running jobs are leased to their process and renewed while it renders; jobs of a
+    # process that stopped renewing are picked up by another once the lease runs out
+    AVATAR_JOB_LEASE_SECONDS: float = float(os.getenv("AVATAR_JOB_LEASE_SECONDS", "60"))
+
+    # WebSocket notifications
+    NOTIFY_BACKEND: str = os.getenv("NOTIFY_BACKEND", "memory") # "memory" or "sqlite" (several workers)
+    NOTIFY_POLL_SECONDS: float = float(os.getenv("NOTIFY_POLL_SECONDS", "0.25"))
+    NOTIFY_RETENTION_SECONDS: float = float(os.getenv("NOTIFY_RETENTION_SECONDS", "60"))
+    WS_SEND_QUEUE_SIZE: int = int(os.getenv("WS_SEND_QUEUE_SIZE", "32"))
+    WS_HEARTBEAT_SECONDS: float = float(os.getenv("WS_HEARTBEAT_SECONDS", "20"))
+
+    # Cache of replies to repeated prompts (off by default)
+    RESPONSE_CACHE_ENABLED: bool = os.getenv("RESPONSE_CACHE_ENABLED", "false").lower() in ("1", "true", "yes")
+    RESPONSE_CACHE_SIZE: int = int(os.getenv("RESPONSE_CACHE_SIZE", "1024"))
+    RESPONSE_CACHE_TTL_SECONDS: float = float(os.getenv("RESPONSE_CACHE_TTL_SECONDS", "3600"))
+    # Minimum cosine similarity for a semantic hit
+    RESPONSE_CACHE_SIMILARITY: float = float(os.getenv("RESPONSE_CACHE_SIMILARITY", "0.92"))
+
+    # Instrumentation: Server-Timing header and/or a log line with the stage timings of each chat turn
+    METRICS_TIMING_HEADER: bool = os.getenv("METRICS_TIMING_HEADER", "false").lower() in ("1", "true", "yes")
+    METRICS_LOG_TIMINGS: bool = os.getenv("METRICS_LOG_TIMINGS", "false").lower() in ("1", "true", "yes")
+
+    # Load the embedding model and open the vector stores in the background at startup;
+    # /readyz reports ready once that is done. When off, they load on first use.
+    WARMUP_ON_STARTUP: bool = os.getenv("WARMUP_ON_STARTUP", "true").lower() in ("1", "true", "yes")
+
+    # Shared embedding model
+    EMBEDDING_CACHE_SIZE: int = int(os.getenv("EMBEDDING_CACHE_SIZE", "2048"))
+    EMBEDDING_BATCH_WINDOW_MS: float = float(os.getenv("EMBEDDING_BATCH_WINDOW_MS", "2"))
 
 settings = Settings()
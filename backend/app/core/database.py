@@ -1,21 +1,93 @@
-from sqlalchemy import create_engine
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import create_engine, event, inspect, text
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import declarative_base
 from app.core.config import settings
 import os
 
-SQLALCHEMY_DATABASE_URL = f"sqlite:///{os.path.join(settings.BASE_DIR, 'sql_app.db')}"
+DATABASE_PATH = os.path.join(settings.DATA_DIR, 'sql_app.db')
+SQLALCHEMY_DATABASE_URL = f"sqlite:///{DATABASE_PATH}"
+ASYNC_DATABASE_URL = f"sqlite+aiosqlite:///{DATABASE_PATH}"
 
+# Sync engine, only used for schema setup at startup
 engine = create_engine(
     SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
 )
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+# Request handlers use the async engine so database I/O never blocks the event loop
+async_engine = create_async_engine(
+    ASYNC_DATABASE_URL,
+    pool_size=settings.DB_POOL_SIZE,
+    max_overflow=settings.DB_MAX_OVERFLOW,
+    pool_pre_ping=True
+)
+AsyncSessionLocal = async_sessionmaker(async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL lets readers proceed while a writer commits, and synchronous=NORMAL only
+    # fsyncs at checkpoints, which is safe in WAL mode
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA busy_timeout={settings.DB_BUSY_TIMEOUT_MS}")
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA cache_size=-16000") # 16 MB page cache per connection
+    cursor.close()
+
+event.listen(engine, "connect", set_sqlite_pragmas)
+event.listen(async_engine.sync_engine, "connect", set_sqlite_pragmas)
 
 Base = declarative_base()
 
-def get_db():
-    db = SessionLocal()
-    try:
+def create_indexes():
+    # create_all() only adds indexes together with new tables, so databases created
+    # before an index was declared get it here
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
+
+def add_missing_columns():
+    # Minimal forward-only migration: columns declared after a table was created are
+    # added with ALTER TABLE, which SQLite supports for nullable columns
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    column_type = column.type.compile(dialect=engine.dialect)
+                    conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+
+def add_autoincrement():
+    # SQLite cannot change a primary key in place, so a table declared with
+    # sqlite_autoincrement after it was created is rebuilt with it and its rows copied
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if not table.dialect_options["sqlite"]["autoincrement"]:
+                continue
+            sql = conn.execute(
+                text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = :name"), {"name": table.name}
+            ).scalar()
+            if sql is None or "AUTOINCREMENT" in sql.upper():
+                continue
+            conn.execute(text(f'ALTER TABLE {table.name} RENAME TO {table.name}_rebuild'))
+            for index in table.indexes:
+                conn.execute(text(f'DROP INDEX IF EXISTS {index.name}'))
+            table.create(bind=conn)
+            columns = ", ".join(column.name for column in table.columns)
+            conn.execute(text(f'INSERT INTO {table.name} ({columns}) SELECT {columns} FROM {table.name}_rebuild'))
+            conn.execute(text(f'DROP TABLE {table.name}_rebuild'))
+
+def init_schema():
+    # Run once per process before serving: tables, then columns, primary keys and
+    # indexes changed since
+    Base.metadata.create_all(bind=engine)
+    add_missing_columns()
+    add_autoincrement()
+    create_indexes()
+
+async def get_db():
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
@@ -0,0 +1,174 @@
+import bisect
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+from app.core.config import settings
+
+# Prometheus text-format metrics, kept in process. Stage timings of the chat pipeline go
+# to one histogram labelled by stage and, while a request is being traced, into that
+# request's trace as well (see trace_request() and the middleware in main.py).
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+def escape_label(value) -> str:
+    # Label values are quoted in the text format, so backslashes, quotes and newlines
+    # must be escaped
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def format_labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{escape_label(value)}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.type = "counter"
+        self.values: dict[tuple, float] = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(labels.get(name, "") for name in self.labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, format_labels(self.labels, key), value) for key, value in self.values.items()]
+
+class Gauge(Counter):
+    def __init__(self, name: str, help: str, labels: tuple = (), collect=None):
+        super().__init__(name, help, labels)
+        self.type = "gauge"
+        # Optional callable returning the current value, read on every scrape
+        self.collect = collect
+
+    def set(self, value: float, **labels):
+        key = tuple(labels.get(name, "") for name in self.labels)
+        with self.lock:
+            self.values[key] = value
+
+    def samples(self):
+        if self.collect is not None:
+            return [(self.name, "", self.collect())]
+        return super().samples()
+
+class CounterView(Counter):
+    # Counter whose values are already tracked by a service; `collect` returns a dict of
+    # label value -> count for the single label, or a number when there are no labels
+    def __init__(self, name: str, help: str, collect, label: str = None):
+        super().__init__(name, help, (label,) if label else ())
+        self.collect = collect
+
+    def samples(self):
+        values = self.collect()
+        if not self.labels:
+            return [(self.name, "", values)]
+        return [(self.name, format_labels(self.labels, (key,)), value) for key, value in values.items()]
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.type = "histogram"
+        self.buckets = buckets
+        # label values -> [per-bucket counts..., +Inf count], sum
+        self.counts: dict[tuple, list] = {}
+        self.sums: dict[tuple, float] = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels.get(name, "") for name in self.labels)
+        with self.lock:
+            counts = self.counts.setdefault(key, [0] * (len(self.buckets) + 1))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.sums[key] = self.sums.get(key, 0.0) + value
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for key, counts in self.counts.items():
+                cumulative = 0
+                for bound, count in zip(list(self.buckets) + ["+Inf"], counts):
+                    cumulative += count
+                    samples.append((f"{self.name}_bucket", format_labels(self.labels + ("le",), key + (bound,)), cumulative))
+                samples.append((f"{self.name}_sum", format_labels(self.labels, key), self.sums[key]))
+                samples.append((f"{self.name}_count", format_labels(self.labels, key), cumulative))
+        return samples
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{labels} {value}")
+        return "\n".join(lines) + "\n"
+
+registry = Registry()
+
+stage_seconds = registry.register(Histogram(
+    "chat_stage_seconds", "Time spent in each stage of a chat turn", ("stage",)
+))
+errors_total = registry.register(Counter(
+    "chatbot_errors_total", "Errors caught and handled, by component", ("component",)
+))
+events_total = registry.register(Counter(
+    "chatbot_events_total", "Notable events such as model loads, resumed jobs and clean-ups, by component", ("component",)
+))
+
+# Stage timings of the request being handled, None outside a traced request
+current_trace: contextvars.ContextVar = contextvars.ContextVar("current_trace", default=None)
+
+@contextmanager
+def stage(name: str):
+    # with stage("gemini"): ...  -- works in sync and async code alike
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        stage_seconds.observe(elapsed, stage=name)
+        trace = current_trace.get()
+        if trace is not None:
+            trace.append((name, elapsed))
+
+def trace_request() -> list:
+    # Starts a trace for the current request; stages recorded from here on (including
+    # in tasks started later from this context) are appended to the returned list
+    trace = []
+    current_trace.set(trace)
+    return trace
+
+def server_timing(trace: list) -> str:
+    # Server-Timing header value, durations in milliseconds
+    return ", ".join(f"{name};dur={elapsed * 1000:.1f}" for name, elapsed in trace)
+
+def log_trace(label: str, trace: list):
+    if settings.METRICS_LOG_TIMINGS and trace:
+        total = sum(elapsed for _, elapsed in trace)
+        stages = " ".join(f"{name}={elapsed * 1000:.1f}ms" for name, elapsed in trace)
+        print(f"[timing] {label} total={total * 1000:.1f}ms {stages}")
+
+def report_error(component: str, message: str):
+    # Single exit for handled errors: counted on /metrics and written to the log
+    errors_total.inc(component=component)
+    print(f"[error] {component}: {message}")
+
+def report_event(component: str, message: str):
+    # Same for things worth a log line that are not errors
+    events_total.inc(component=component)
+    print(f"[event] {component}: {message}")
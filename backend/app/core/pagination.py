@@ -0,0 +1,42 @@
+import base64
+from datetime import datetime
+from sqlalchemy import and_, or_
+
+# Keyset (cursor) pagination over a (timestamp, id) ordering. A cursor is the position of
+# the last row of a page, so the next page is a range scan on the index from that point
+# instead of an OFFSET that re-reads every earlier row.
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+def encode_cursor(timestamp: datetime, key) -> str:
+    raw = f"{timestamp.isoformat()}|{key}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str, key_type=str):
+    # Raises ValueError for anything that was not produced by encode_cursor
+    padded = cursor + "=" * (-len(cursor) % 4)
+    timestamp, key = base64.urlsafe_b64decode(padded.encode()).decode().split("|", 1)
+    return datetime.fromisoformat(timestamp), key_type(key)
+
+def paginate(stmt, timestamp_column, key_column, before: str = None, after: str = None, limit: int = DEFAULT_PAGE_SIZE, key_type=str):
+    # Returns (statement, newest_first). Without a cursor, or with `before`, the page walks
+    # towards older rows; with `after` it walks towards newer rows. One extra row is
+    # fetched so the caller can tell whether another page exists.
+    if after:
+        timestamp, key = decode_cursor(after, key_type)
+        stmt = stmt.where(or_(
+            timestamp_column > timestamp,
+            and_(timestamp_column == timestamp, key_column > key)
+        )).order_by(timestamp_column, key_column)
+        newest_first = False
+    else:
+        if before:
+            timestamp, key = decode_cursor(before, key_type)
+            stmt = stmt.where(or_(
+                timestamp_column < timestamp,
+                and_(timestamp_column == timestamp, key_column < key)
+            ))
+        stmt = stmt.order_by(timestamp_column.desc(), key_column.desc())
+        newest_first = True
+    return stmt.limit(limit + 1), newest_first
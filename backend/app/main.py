@@ -1,25 +1,53 @@
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, BackgroundTasks, Depends, HTTPException
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, BackgroundTasks, Depends, HTTPException, Query, Response, Request
 from fastapi.staticfiles import StaticFiles
+from fastapi.responses import StreamingResponse, PlainTextResponse, FileResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from sqlalchemy.orm import Session
-from typing import List
+from sqlalchemy import select, delete
+from sqlalchemy.ext.asyncio import AsyncSession
+from datetime import datetime
+from typing import List, Optional
+from contextlib import asynccontextmanager
+import asyncio
 import os
 import uuid
 import json
 
 from app.services.gemini_service import gemini_service
-from app.services.emotion_manager import emotion_manager
 from app.services.history_manager import history_manager
-from app.services.image_generator import image_generator
+from app.services.embedding_service import embedding_service
+from app.services.context_builder import context_builder
+from app.services.response_cache import response_cache
+from app.services.avatar_index import avatar_index, BASE_CATEGORY_AVATARS
+from app.services.avatar_generation import avatar_generation
+from app.services.image_generator import image_generator, MEDIA_TYPES
+from app.services.notifications import connection_manager, broker
 from app.core.config import settings
-from app.core.database import engine, get_db, Base
+from app.core.database import get_db, AsyncSessionLocal, init_schema
+from app.core.pagination import paginate, encode_cursor, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
+from app.core.metrics import registry, stage, trace_request, current_trace, server_timing, log_trace, report_error
 from app import models
 
-# Create Tables
-Base.metadata.create_all(bind=engine)
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await asyncio.to_thread(init_schema)
+    # Fails startup when HISTORY_SHARDS does not match the existing history store
+    await asyncio.to_thread(history_manager.get_client)
+    await broker.start()
+    await avatar_generation.start(notify_avatar_update)
+    if settings.WARMUP_ON_STARTUP:
+        # Requests are accepted meanwhile, the first ones wait for whatever they need
+        app.state.warmup = asyncio.create_task(run_warmup())
+    app.state.started = True
+    yield
+    await avatar_generation.stop()
+    await broker.stop()
 
-app = FastAPI(title=settings.PROJECT_NAME)
+# Nothing heavy happens at import: the schema is set up at startup, the embedding model
+# and the Chroma stores load in the background (or on first use), see /readyz
+app = FastAPI(title=settings.PROJECT_NAME, lifespan=lifespan)
+app.state.started = False
+app.state.warmup = None
 
 # CORS
 app.add_middleware(
@@ -28,59 +56,55 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "Server-Timing"],
 )
 
+@app.middleware("http")
+async def trace_chat_requests(request, call_next):
+    # Collects the stage timings of chat turns for the Server-Timing header and log line
+    if not request.url.path.startswith("/api/v1/chat"):
+        return await call_next(request)
+    trace = trace_request()
+    response = await call_next(request)
+    if settings.METRICS_TIMING_HEADER:
+        # Streamed replies only carry the stages finished before the first byte
+        response.headers["Server-Timing"] = server_timing(trace)
+    return response
+
 # Static Files
 os.makedirs(settings.STATIC_DIR, exist_ok=True)
 app.mount("/static", StaticFiles(directory=settings.STATIC_DIR), name="static")
 
-# WebSocket Connection Manager
-class ConnectionManager:
-    def __init__(self):
-        self.active_connections: dict[str, WebSocket] = {}
-
-    async def connect(self, websocket: WebSocket, session_id: str):
-        await websocket.accept()
-        self.active_connections[session_id] = websocket
-
-    def disconnect(self, session_id: str):
-        if session_id in self.active_connections:
-            del self.active_connections[session_id]
-
-    async def send_personal_message(self, message: dict, session_id: str):
-        if session_id in self.active_connections:
-            await self.active_connections[session_id].send_json(message)
-
-manager = ConnectionManager()
-
 @app.websocket("/ws/{session_id}")
 async def websocket_endpoint(websocket: WebSocket, session_id: str):
-    await manager.connect(websocket, session_id)
+    connection = await connection_manager.connect(websocket, session_id)
     try:
         while True:
             await websocket.receive_text() # Keep connection alive
     except WebSocketDisconnect:
-        manager.disconnect(session_id)
+        pass
+    finally:
+        connection_manager.disconnect(connection)
 
-async def generate_and_notify(session_id: str, emotion_description: str):
-    # Generate Image
-    image_url = await image_generator.generate_avatar(emotion_description)
-    
-    if image_url:
-        # Update ChromaDB
-        emotion_id = f"generated_{uuid.uuid4()}"
-        emotion_manager.add_emotion(
-            emotion_id=emotion_id,
-            description=emotion_description,
-            image_path=image_url,
-            source="ai-generated"
-        )
-        
-        # Notify Frontend
-        await manager.send_personal_message({
-            "event": "avatar_update",
-            "avatar_url": f"http://localhost:8000{image_url}"
-        }, session_id)
+async def notify_avatar_update(session_id: str, image_url: str):
+    # Goes through the broker, so it reaches the session's sockets in any worker
+    await broker.publish({
+        "event": "avatar_update",
+        "avatar_url": image_generator.public_url(image_url),
+        "avatar_thumb_url": image_generator.public_url(image_url, "thumb")
+    }, session_id)
+
+def warm_up():
+    embedding_service.get_model()
+    history_manager.get_shards()
+    avatar_index.load()
+
+async def run_warmup():
+    try:
+        await asyncio.to_thread(warm_up)
+    except Exception as e:
+        report_error("warmup", f"Error warming up: {e}")
+        raise
 
 # --- Pydantic Models ---
 class SessionCreate(BaseModel):
@@ -109,21 +133,48 @@ class ChatRequest(BaseModel):
 # --- Session Endpoints ---
 
 @app.post("/api/v1/sessions", response_model=SessionResponse)
-def create_session(session: SessionCreate, db: Session = Depends(get_db)):
+async def create_session(session: SessionCreate, db: AsyncSession = Depends(get_db)):
     session_id = f"session_{uuid.uuid4()}"
     db_session = models.ChatSession(id=session_id, title=session.title)
     db.add(db_session)
-    db.commit()
-    db.refresh(db_session)
+    await db.commit()
+    await db.refresh(db_session)
     return SessionResponse(
         id=db_session.id, 
         title=db_session.title, 
         created_at=db_session.created_at.isoformat()
     )
 
+async def fetch_page(db: AsyncSession, stmt, timestamp_column, key_column, before, after, limit, response: Response, key_type=str):
+    # Runs a keyset-paginated query, returns the rows newest first and sets X-Next-Cursor
+    # when there is another page in the direction that was requested
+    try:
+        stmt, newest_first = paginate(stmt, timestamp_column, key_column, before, after, limit, key_type)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    rows = (await db.execute(stmt)).scalars().all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if has_more:
+        last = rows[-1]
+        response.headers["X-Next-Cursor"] = encode_cursor(getattr(last, timestamp_column.key), getattr(last, key_column.key))
+    return rows if newest_first else list(reversed(rows))
+
 @app.get("/api/v1/sessions", response_model=List[SessionResponse])
-def get_sessions(db: Session = Depends(get_db)):
-    sessions = db.query(models.ChatSession).order_by(models.ChatSession.created_at.desc()).all()
+async def get_sessions(
+    response: Response,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    before: Optional[str] = None,
+    after: Optional[str] = None,
+    db: AsyncSession = Depends(get_db)
+):
+    # Newest first. Pass X-Next-Cursor back as `before` for older sessions, or as `after`
+    # when paging towards newer ones.
+    sessions = await fetch_page(
+        db, select(models.ChatSession),
+        models.ChatSession.created_at, models.ChatSession.id,
+        before, after, limit, response
+    )
     return [
         SessionResponse(
             id=s.id, 
@@ -133,112 +184,277 @@ def get_sessions(db: Session = Depends(get_db)):
     ]
 
 @app.get("/api/v1/sessions/{session_id}/messages", response_model=List[MessageResponse])
-def get_session_messages(session_id: str, db: Session = Depends(get_db)):
-    messages = db.query(models.ChatMessage).filter(models.ChatMessage.session_id == session_id).order_by(models.ChatMessage.timestamp).all()
+async def get_session_messages(
+    session_id: str,
+    response: Response,
+    limit: int = Query(100, ge=1, le=MAX_PAGE_SIZE),
+    before: Optional[str] = None,
+    after: Optional[str] = None,
+    db: AsyncSession = Depends(get_db)
+):
+    # The latest `limit` messages in chronological order. Pass X-Next-Cursor back as
+    # `before` to load earlier messages, or as `after` when paging forward.
+    messages = await fetch_page(
+        db, select(models.ChatMessage).where(models.ChatMessage.session_id == session_id),
+        models.ChatMessage.timestamp, models.ChatMessage.id,
+        before, after, limit, response, key_type=int
+    )
     return [
         MessageResponse(
             sender=m.sender, 
             content=m.content, 
             timestamp=m.timestamp.isoformat()
-        ) for m in messages
+        ) for m in reversed(messages)
     ]
 
+@app.get("/api/v1/sessions/{session_id}/export")
+async def export_session_messages(session_id: str):
+    # Full thread as a JSON array, streamed from the database in chunks so memory stays
+    # flat however long the session is
+    async def export_stream():
+        async with AsyncSessionLocal() as db:
+            rows = await db.stream_scalars(
+                select(models.ChatMessage)
+                .where(models.ChatMessage.session_id == session_id)
+                .order_by(models.ChatMessage.timestamp, models.ChatMessage.id)
+                .execution_options(yield_per=500)
+            )
+            yield "["
+            first = True
+            async for m in rows:
+                item = json.dumps({"sender": m.sender, "content": m.content, "timestamp": m.timestamp.isoformat()})
+                yield item if first else "," + item
+                first = False
+            yield "]"
+
+    return StreamingResponse(export_stream(), media_type="application/json")
+
 @app.delete("/api/v1/sessions/{session_id}")
-def delete_session(session_id: str, db: Session = Depends(get_db)):
-    session = db.query(models.ChatSession).filter(models.ChatSession.id == session_id).first()
+async def delete_session(session_id: str, db: AsyncSession = Depends(get_db)):
+    session = await db.get(models.ChatSession, session_id)
     if not session:
         raise HTTPException(status_code=404, detail="Session not found")
-    db.delete(session)
-    db.commit()
+    # Bulk deletes instead of the ORM cascade, which would load every message first
+    await db.execute(delete(models.ChatMessage).where(models.ChatMessage.session_id == session_id))
+    await db.execute(delete(models.ChatSession).where(models.ChatSession.id == session_id))
+    await db.commit()
+    # The session's vectors live in one history shard, dropping them is a filtered delete there
+    await asyncio.to_thread(history_manager.delete_session, session_id)
     return {"status": "success", "message": "Session deleted"}
 
-@app.post("/api/v1/chat")
-async def chat(request: ChatRequest, background_tasks: BackgroundTasks, db: Session = Depends(get_db)):
-    # Ensure session exists in SQLite
-    db_session = db.query(models.ChatSession).filter(models.ChatSession.id == request.session_id).first()
+async def start_turn(db: AsyncSession, request: ChatRequest):
+    # All writes of a turn are held back and committed together in finish_turn
+    db_session = await db.get(models.ChatSession, request.session_id)
     if not db_session:
         # Auto-create if not exists (fallback)
         db_session = models.ChatSession(id=request.session_id, title="New Chat")
-        db.add(db_session)
-        db.commit()
 
-    # Save User Message to SQLite
-    user_msg = models.ChatMessage(session_id=request.session_id, sender="user", content=request.user_message)
-    db.add(user_msg)
-    db.commit()
+    user_msg = models.ChatMessage(
+        session_id=request.session_id,
+        sender="user",
+        content=request.user_message,
+        timestamp=datetime.utcnow()
+    )
 
     # Phase 3: Automated Generation & Real-time Experience
     
     # 0. Retrieve Context (History)
-    context = history_manager.retrieve_context(request.session_id, request.user_message)
-    if not context:
-        context = history_manager.retrieve_last_n(request.session_id)
+    # The question is embedded once here and reused when the exchange is stored
+    with stage("embed_question"):
+        question_embedding = await history_manager.embed_question(request.user_message)
+    # Summary, recent turns and semantic hits, bounded by CONTEXT_TOKEN_BUDGET
+    with stage("retrieve_context"):
+        context = await context_builder.build(db, db_session, question_embedding)
+    # Release the connection back to the pool while Gemini runs
+    await db.commit()
+
+    return db_session, user_msg, context, question_embedding
 
-    # 1. Get text response and emotion description from Gemini
-    gemini_response = await gemini_service.generate_response(request.user_message, context)
+async def finish_turn(db: AsyncSession, db_session: models.ChatSession, user_msg: models.ChatMessage, request: ChatRequest, gemini_response: dict, background_tasks: BackgroundTasks, question_embedding=None):
     reply_text = gemini_response.get("reply_text", "")
     emotion_description = gemini_response.get("emotion_description", "neutral")
     emotion_category = gemini_response.get("emotion_category", "neutral").lower()
     
-    # Save Bot Message to SQLite
+    # Session upsert, both messages and the title update go out in one transaction
+    db.add(db_session)
+    db.add(user_msg)
     bot_msg = models.ChatMessage(session_id=request.session_id, sender="bot", content=reply_text)
     db.add(bot_msg)
-    db.commit()
 
     # Update Session Title if it's the first message
     if db_session.title == "New Chat":
         # Simple heuristic: use first few words of user message
         new_title = " ".join(request.user_message.split()[:5])
         db_session.title = new_title
-        db.commit()
+    with stage("db_commit"):
+        await db.commit()
 
     # Store the new interaction in history (ChromaDB)
-    history_manager.store_chat_history(request.session_id, request.user_message, reply_text)
-    
-    should_generate = True
-    avatar_url = None
-
-    # 0. Check for direct category match (Keyword Search Strategy)
-    # Map categories to seeded IDs
-    category_map = {
-        "happy": "happy_01",
-        "sad": "sad_01",
-        "angry": "angry_01",
-        "confused": "confused_01",
-        "neutral": "neutral_01"
-    }
+    with stage("store_history"):
+        await history_manager.store_chat_history(
+            request.session_id, user_msg.id, bot_msg.id,
+            request.user_message, reply_text,
+            question_embedding=question_embedding
+        )
+    # Keep the rolling summary current for long sessions
+    with stage("schedule_summary"):
+        background_tasks.add_task(context_builder.update_summary, request.session_id)
     
-    if emotion_category in category_map:
-        # We have a direct hit for a base emotion
-        # We can verify it exists in DB or just use the known path
-        # For simplicity and speed, we use the known path pattern
-        avatar_url = f"http://localhost:8000/static/avatars/{category_map[emotion_category]}.png"
-        should_generate = False
-    else:
-        # 2. Search for best matching emotion in ChromaDB (Vector Search Strategy)
-        best_emotion = emotion_manager.get_best_emotion(emotion_description)
-        
-        if best_emotion:
-            # Check threshold (adjust based on testing)
-            # If distance is small enough, use existing. Else generate.
-            # Increased threshold from 0.5 to 1.2 to be more lenient
-            if best_emotion['distance'] < 1.2: 
-                should_generate = False
-                # Assuming image_path in metadata is relative like /static/avatars/happy_01.png
-                avatar_url = f"http://localhost:8000{best_emotion['metadata']['image_path']}"
+    # Category hits and previously seen descriptions resolve from memory, only a new
+    # description is embedded and its nearest stored avatars reranked against the
+    # per-category thresholds (and the vector reused if we generate)
+    with stage("resolve_avatar"):
+        image_path, emotion_embedding = await avatar_index.resolve(emotion_category, emotion_description)
+    should_generate = image_path is None
+    avatar_url = image_generator.public_url(image_path) if image_path else None
+    result = None
     
     if should_generate:
-        background_tasks.add_task(generate_and_notify, request.session_id, emotion_description)
-        return {
-            "status": "generating_avatar",
-            "reply_text": reply_text
-        }
-    else:
-        return {
+        # Queued for the avatar workers, near-identical requests share one job
+        with stage("submit_avatar_job"):
+            job = await avatar_generation.submit(request.session_id, emotion_description, emotion_embedding, emotion_category)
+        if job:
+            result = {
+                "status": "generating_avatar",
+                "reply_text": reply_text,
+                "job_id": job["job_id"],
+                "queue_position": job["position"]
+            }
+        else:
+            # Queue is full: answer with the neutral avatar rather than wait
+            image_path = BASE_CATEGORY_AVATARS['neutral']
+            avatar_url = image_generator.public_url(image_path)
+    if result is None:
+        result = {
             "status": "success",
             "reply_text": reply_text,
-            "avatar_url": avatar_url
+            "avatar_url": avatar_url,
+            "avatar_thumb_url": image_generator.public_url(image_path, "thumb") if image_path else None
         }
+    log_trace(f"chat {request.session_id}", current_trace.get())
+    return result
+
+@app.post("/api/v1/chat")
+async def chat(request: ChatRequest, background_tasks: BackgroundTasks, db: AsyncSession = Depends(get_db)):
+    db_session, user_msg, context, question_embedding = await start_turn(db, request)
+
+    # 1. Get text response and emotion description from Gemini, unless this prompt was
+    # answered recently under the same context
+    with stage("response_cache"):
+        gemini_response = response_cache.get(request.user_message, context, question_embedding)
+    if gemini_response is None:
+        with stage("gemini"):
+            gemini_response = await gemini_service.generate_response(request.user_message, context)
+        response_cache.put(request.user_message, context, gemini_response, question_embedding)
+
+    return await finish_turn(db, db_session, user_msg, request, gemini_response, background_tasks, question_embedding)
+
+def sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.post("/api/v1/chat/stream")
+async def chat_stream(request: ChatRequest, background_tasks: BackgroundTasks):
+    # Server-Sent Events: "token" events carry reply_text pieces as Gemini emits them,
+    # a final "done" event carries the same payload as POST /api/v1/chat.
+    async def event_stream():
+        # The session outlives the request handler, so it is owned by the stream itself
+        async with AsyncSessionLocal() as db:
+            db_session, user_msg, context, question_embedding = await start_turn(db, request)
+
+            with stage("response_cache"):
+                gemini_response = response_cache.get(request.user_message, context, question_embedding)
+            if gemini_response is not None:
+                # Cached reply goes out as a single token event
+                yield sse_event("token", {"text": gemini_response.get("reply_text", "")})
+            else:
+                # Includes the time spent writing tokens to the client
+                with stage("gemini_stream"):
+                    async for event in gemini_service.stream_response(request.user_message, context):
+                        if event["type"] == "token":
+                            yield sse_event("token", {"text": event["text"]})
+                        else:
+                            # The result event without its SSE type
+                            gemini_response = {k: v for k, v in event.items() if k != "type"}
+                response_cache.put(request.user_message, context, gemini_response, question_embedding)
+
+            # Avatar generation is queued on background_tasks, which run after the stream closes
+            result = await finish_turn(db, db_session, user_msg, request, gemini_response, background_tasks, question_embedding)
+            yield sse_event("done", result)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        background=background_tasks
+    )
+
+@app.get("/api/v1/stats/embeddings")
+def get_embedding_stats():
+    return embedding_service.stats()
+
+@app.get("/api/v1/stats/response-cache")
+def get_response_cache_stats():
+    return response_cache.stats()
+
+@app.get("/api/v1/avatar-jobs/{job_id}")
+async def get_avatar_job(job_id: int):
+    job = await avatar_generation.job_status(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+@app.get("/api/v1/avatars/{filename}")
+async def get_avatar_asset(filename: str, request: Request):
+    # Generated avatars are content-addressed, so every file is immutable: a strong ETag
+    # from its name and a year of client caching
+    filepath = await asyncio.to_thread(image_generator.asset_path, filename)
+    if not filepath:
+        raise HTTPException(status_code=404, detail="Avatar not found")
+    headers = {
+        "ETag": f'"{filename}"',
+        "Cache-Control": "public, max-age=31536000, immutable"
+    }
+    if headers["ETag"] in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers)
+    media_type = MEDIA_TYPES[os.path.splitext(filename)[1]]
+    return FileResponse(filepath, media_type=media_type, headers=headers)
+
+@app.get("/api/v1/stats/connections")
+def get_connection_stats():
+    return connection_manager.stats()
+
+@app.get("/api/v1/stats/avatars")
+async def get_avatar_stats():
+    return await avatar_generation.stats()
+
+@app.get("/api/v1/stats/avatar-matches")
+def get_avatar_match_stats():
+    return avatar_index.stats()
+
+@app.get("/metrics")
+def get_metrics():
+    # Prometheus text exposition format
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/healthz")
+def healthz():
+    # Liveness: the process is up and serving
+    return {"status": "ok"}
+
+@app.get("/readyz")
+def readyz(response: Response):
+    # Readiness: startup finished and, with WARMUP_ON_STARTUP, the warm-up is done
+    warmup = app.state.warmup
+    checks = {
+        "started": app.state.started,
+        "embedding_model": embedding_service.model is not None,
+        "history_store": history_manager.shards is not None,
+        "avatar_index": avatar_index.loaded
+    }
+    ready = app.state.started and (warmup is None or (warmup.done() and not warmup.cancelled() and warmup.exception() is None))
+    if not ready:
+        response.status_code = 503
+    return {"status": "ready" if ready else "starting", "checks": checks}
 
 @app.get("/")
 def read_root():
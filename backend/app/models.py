@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey
+from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, Index
 from sqlalchemy.orm import relationship
 from app.core.database import Base
 from datetime import datetime
@@ -9,9 +9,17 @@ class ChatSession(Base):
     id = Column(String, primary_key=True, index=True)
     title = Column(String, default="New Chat")
     created_at = Column(DateTime, default=datetime.utcnow)
+    # Rolling summary of the turns that have aged out of the recent-context window
+    summary = Column(Text, nullable=True)
+    summary_upto_message_id = Column(Integer, default=0)
     
     messages = relationship("ChatMessage", back_populates="session", cascade="all, delete-orphan")
 
+    __table_args__ = (
+        # Keyset pagination of the session list, newest first
+        Index("ix_sessions_created_at_id", "created_at", "id"),
+    )
+
 class ChatMessage(Base):
     __tablename__ = "messages"
 
@@ -22,3 +30,48 @@ class ChatMessage(Base):
     timestamp = Column(DateTime, default=datetime.utcnow)
 
     session = relationship("ChatSession", back_populates="messages")
+
+    __table_args__ = (
+        # Serves "latest messages of a session" without scanning the table
+        Index("ix_messages_session_timestamp", "session_id", "timestamp"),
+    )
+
+class AvatarJob(Base):
+    # Persisted avatar generation job, survives restarts
+    __tablename__ = "avatar_jobs"
+
+    id = Column(Integer, primary_key=True, index=True)
+    status = Column(String, default="queued") # "queued", "running", "done" or "failed"
+    priority = Column(Integer, default=0) # higher runs first
+    description = Column(Text)
+    category = Column(String, nullable=True)
+    embedding = Column(Text, nullable=True) # JSON list of floats
+    session_ids = Column(Text, default="[]") # JSON list of sessions waiting for the result
+    attempts = Column(Integer, default=0)
+    # Process running the job, and until when; a running job whose lease has passed
+    # belongs to a process that stopped and is claimed again
+    claimed_by = Column(String, nullable=True)
+    lease_until = Column(DateTime, nullable=True)
+    image_url = Column(String, nullable=True)
+    error = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    available_at = Column(DateTime, default=datetime.utcnow) # pushed back between retries
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    __table_args__ = (
+        # Workers claim the next queued job by priority, oldest first
+        Index("ix_avatar_jobs_status_priority", "status", "priority", "id"),
+    )
+
+class Notification(Base):
+    # Outbox for the cross-process notification broker, pruned after a short retention
+    __tablename__ = "notifications"
+
+    id = Column(Integer, primary_key=True, index=True)
+    session_id = Column(String)
+    payload = Column(Text) # JSON message
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
+
+    # Ids are never reused, even after pruning has emptied the table: pollers only look
+    # at ids above the last one they have seen
+    __table_args__ = {"sqlite_autoincrement": True}
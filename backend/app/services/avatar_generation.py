@@ -0,0 +1,438 @@
+import asyncio
+import hashlib
+import json
+import multiprocessing
+import os
+import socket
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timedelta
+from sqlalchemy import select, update, func, and_, or_, case
+from app.core.config import settings
+from app.core.database import AsyncSessionLocal
+from app.core.metrics import registry, Gauge, CounterView, report_error, report_event
+from app import models
+from app.services.emotion_manager import emotion_manager
+from app.services.embedding_service import embedding_service
+from app.services.image_generator import image_generator
+from app.services.avatar_index import avatar_index, normalize_description
+
+# Chat turns outrank anything submitted in bulk
+INTERACTIVE_PRIORITY = 10
+# Pause before a worker retries after the queue itself errored (database locked or gone)
+WORKER_ERROR_BACKOFF_SECONDS = 5
+
+def claimable(now: datetime):
+    # Queued jobs whose retry delay has passed, and running jobs whose lease expired
+    # (including rows from before leases existed)
+    return or_(
+        and_(models.AvatarJob.status == "queued", models.AvatarJob.available_at <= now),
+        and_(
+            models.AvatarJob.status == "running",
+            or_(models.AvatarJob.lease_until.is_(None), models.AvatarJob.lease_until < now)
+        )
+    )
+
+def squared_distance(a, b) -> float:
+    # Same metric as the Chroma collections (squared L2)
+    return sum((x - y) ** 2 for x, y in zip(a, b))
+
+class AvatarGeneration:
+    # Avatar generation queue. Jobs are persisted in the avatar_jobs table and run by a
+    # fixed number of worker coroutines, which render in a process pool so Pillow never
+    # runs on the event loop. A request whose description is close enough to a job that
+    # is still queued or running joins that job instead of starting another, and every
+    # waiting session is notified when the shared image is ready.
+    def __init__(self):
+        self.threshold = settings.AVATAR_COALESCE_THRESHOLD
+        self.worker_count = settings.AVATAR_WORKERS
+        self.max_queued = settings.AVATAR_QUEUE_MAX
+        self.max_attempts = settings.AVATAR_JOB_MAX_ATTEMPTS
+        self.retry_delay = settings.AVATAR_JOB_RETRY_SECONDS
+        self.lease = settings.AVATAR_JOB_LEASE_SECONDS
+        # Identifies this process in claimed_by, unique across hosts and restarts
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+        # job_id -> {"key", "embedding"} for every queued or running job; the embedding of
+        # a job resumed without one is filled in when it runs
+        self.active: dict[int, dict] = {}
+        self.notify = None
+        self.pool = None
+        self.workers: list[asyncio.Task] = []
+        self.wakeup = asyncio.Event()
+
+        self.generations = 0
+        self.coalesced = 0
+        self.rejected = 0
+        self.failures = 0
+        self.removed_files = 0
+
+    async def start(self, notify):
+        # `notify(session_id, image_url)` is awaited for each waiting session once a job is done
+        self.notify = notify
+        self.pool = self.make_pool()
+
+        async with AsyncSessionLocal() as db:
+            # Jobs running in other live processes keep their lease; those left behind by a
+            # stopped process are claimable again once it has expired
+            jobs = (await db.execute(select(models.AvatarJob).where(
+                or_(models.AvatarJob.status == "queued", claimable(datetime.utcnow()))
+            ))).scalars().all()
+        for job in jobs:
+            # Jobs without a stored embedding get one when they run, not on the startup path
+            embedding = json.loads(job.embedding) if job.embedding else None
+            self.active[job.id] = {"key": normalize_description(job.description), "embedding": embedding}
+
+        self.workers = [asyncio.create_task(self.worker()) for _ in range(self.worker_count)]
+        if settings.AVATAR_GC_INTERVAL_SECONDS > 0:
+            self.workers.append(asyncio.create_task(self.gc_loop()))
+        if jobs:
+            report_event("avatar_generation", f"Resumed {len(jobs)} queued avatar jobs")
+
+    def make_pool(self):
+        # spawn, not fork: the parent holds threads (Chroma, the embedding model) that
+        # must not be copied mid-operation into the children
+        return ProcessPoolExecutor(max_workers=self.worker_count, mp_context=multiprocessing.get_context("spawn"))
+
+    def replace_pool(self, broken):
+        # A child that died (OOM, a crash in Pillow) breaks the whole pool for good. Every
+        # worker that hits it ends up here, only the first one swaps in a new pool.
+        if self.pool is broken:
+            broken.shutdown(wait=False, cancel_futures=True)
+            self.pool = self.make_pool()
+            report_error("avatar_generation", "Avatar render pool broke, started a new one")
+
+    async def stop(self):
+        for task in self.workers:
+            task.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+        if self.pool:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
+
+    def find_active(self, key: str, embedding):
+        for job_id, entry in self.active.items():
+            if entry["key"] == key:
+                return job_id
+        for job_id, entry in self.active.items():
+            if entry["embedding"] is not None and squared_distance(entry["embedding"], embedding) < self.threshold:
+                return job_id
+        return None
+
+    async def submit(self, session_id: str, description: str, embedding=None, category: str = None, priority: int = INTERACTIVE_PRIORITY):
+        # Returns {"job_id", "position"}, or None when the queue is full
+        if embedding is None:
+            embedding = (await embedding_service.aembed([description]))[0]
+        key = normalize_description(description)
+
+        async with AsyncSessionLocal() as db:
+            job_id = self.find_active(key, embedding)
+            if job_id is not None:
+                job = await self.join(db, job_id, session_id)
+                if job and job.status in ("queued", "running"):
+                    self.coalesced += 1
+                    return {"job_id": job.id, "position": await self.position(db, job)}
+                # Finished or failed, possibly by another process: the entry is stale
+                self.active.pop(job_id, None)
+                if job and job.status == "done":
+                    # Finished between the lookup and the join, hand the image over directly
+                    self.coalesced += 1
+                    await self.notify(session_id, job.image_url)
+                    return {"job_id": job.id, "position": 0}
+
+            # Backpressure: beyond this many waiting jobs, callers fall back to an existing avatar
+            queued = await db.scalar(select(func.count()).select_from(models.AvatarJob).where(models.AvatarJob.status == "queued"))
+            if queued >= self.max_queued:
+                self.rejected += 1
+                return None
+
+            job = models.AvatarJob(
+                description=description,
+                category=category,
+                embedding=json.dumps(list(embedding)),
+                session_ids=json.dumps([session_id]),
+                priority=priority
+            )
+            db.add(job)
+            await db.commit()
+            self.active[job.id] = {"key": key, "embedding": embedding}
+            position = await self.position(db, job)
+
+        self.wakeup.set()
+        return {"job_id": job.id, "position": position}
+
+    async def join(self, db, job_id: int, session_id: str):
+        # Adds the session to the job's waiters with a single UPDATE that only applies while
+        # the job is queued or running. run() marks the job done and reads the waiters in
+        # one transaction, so a join either lands before that and is notified, or finds
+        # the job done. Returns the job as it is after the join.
+        waiter = json.dumps(session_id)
+        await db.execute(
+            update(models.AvatarJob)
+            .where(models.AvatarJob.id == job_id, models.AvatarJob.status.in_(("queued", "running")))
+            .values(session_ids=case(
+                (func.instr(models.AvatarJob.session_ids, waiter) > 0, models.AvatarJob.session_ids),
+                else_=func.json_insert(models.AvatarJob.session_ids, "$[#]", session_id)
+            ))
+            .execution_options(synchronize_session=False)
+        )
+        await db.commit()
+        return await db.get(models.AvatarJob, job_id, populate_existing=True)
+
+    async def position(self, db, job: models.AvatarJob) -> int:
+        # 0 while running, otherwise 1 + the number of queued jobs that will run before it
+        if job.status != "queued":
+            return 0
+        ahead = await db.scalar(
+            select(func.count()).select_from(models.AvatarJob).where(
+                models.AvatarJob.status == "queued",
+                or_(
+                    models.AvatarJob.priority > job.priority,
+                    and_(models.AvatarJob.priority == job.priority, models.AvatarJob.id < job.id)
+                )
+            )
+        )
+        return ahead + 1
+
+    async def claim(self):
+        async with AsyncSessionLocal() as db:
+            while True:
+                now = datetime.utcnow()
+                job = await db.scalar(
+                    select(models.AvatarJob)
+                    .where(claimable(now))
+                    .order_by(models.AvatarJob.priority.desc(), models.AvatarJob.id)
+                    .limit(1)
+                )
+                if not job:
+                    return None
+                # Conditional update, so two workers (or two processes) never claim the same job
+                result = await db.execute(
+                    update(models.AvatarJob)
+                    .where(models.AvatarJob.id == job.id, claimable(now))
+                    .values(
+                        status="running",
+                        attempts=models.AvatarJob.attempts + 1,
+                        claimed_by=self.owner,
+                        lease_until=now + timedelta(seconds=self.lease)
+                    )
+                    .execution_options(synchronize_session=False)
+                )
+                await db.commit()
+                if result.rowcount == 1:
+                    await db.refresh(job)
+                    return job
+
+    async def worker(self):
+        while True:
+            try:
+                job = await self.claim()
+                if not job:
+                    await self.prune_active()
+            except Exception as e:
+                # Keep the worker alive, an error here would otherwise end the task for good
+                report_error("avatar_generation", f"Error claiming an avatar job: {e}")
+                await asyncio.sleep(WORKER_ERROR_BACKOFF_SECONDS)
+                continue
+            if not job:
+                # Woken by submit(); the timeout picks up retries whose delay has passed
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=1.0)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            lease = asyncio.create_task(self.renew_lease(job.id))
+            try:
+                await self.run(job)
+            except Exception as e:
+                try:
+                    await self.fail(job, str(e))
+                except Exception as e:
+                    # The job keeps its lease until it expires, then it is claimed again
+                    report_error("avatar_generation", f"Error recording failure of avatar job {job.id}: {e}")
+                    await asyncio.sleep(WORKER_ERROR_BACKOFF_SECONDS)
+            finally:
+                lease.cancel()
+
+    async def prune_active(self):
+        # Drops entries for jobs that another process finished or gave up on, so they are
+        # no longer offered to new requests
+        if not self.active:
+            return
+        async with AsyncSessionLocal() as db:
+            live = set((await db.scalars(
+                select(models.AvatarJob.id).where(
+                    models.AvatarJob.id.in_(list(self.active)),
+                    models.AvatarJob.status.in_(("queued", "running"))
+                )
+            )).all())
+        for job_id in list(self.active):
+            if job_id not in live:
+                self.active.pop(job_id, None)
+
+    async def renew_lease(self, job_id: int):
+        # Keeps the claim alive while this process works on the job
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            try:
+                async with AsyncSessionLocal() as db:
+                    await db.execute(
+                        update(models.AvatarJob)
+                        .where(models.AvatarJob.id == job_id, models.AvatarJob.status == "running", models.AvatarJob.claimed_by == self.owner)
+                        .values(lease_until=datetime.utcnow() + timedelta(seconds=self.lease))
+                        .execution_options(synchronize_session=False)
+                    )
+                    await db.commit()
+            except Exception as e:
+                report_error("avatar_generation", f"Error renewing lease of avatar job {job_id}: {e}")
+
+    async def run(self, job: models.AvatarJob):
+        self.generations += 1
+        entry = self.active.get(job.id)
+        embedding = entry["embedding"] if entry else None
+        if embedding is None:
+            embedding = json.loads(job.embedding) if job.embedding else (await embedding_service.aembed([job.description]))[0]
+            if entry:
+                # Similar requests can join the job while it renders
+                entry["embedding"] = embedding
+        pool = self.pool
+        try:
+            image_url = await image_generator.generate_avatar(job.description, executor=pool)
+        except BrokenProcessPool:
+            # Not the job's fault: run it again on the new pool without using up an attempt
+            self.replace_pool(pool)
+            await self.requeue(job)
+            return
+        if not image_url:
+            await self.fail(job, "image generation failed")
+            return
+
+        # The image file is content-addressed; the Chroma entry is keyed by image and
+        # description, so one image can back several descriptions without duplicates
+        image_stem = os.path.splitext(os.path.basename(image_url))[0]
+        description_hash = hashlib.sha256(normalize_description(job.description).encode()).hexdigest()[:12]
+        await asyncio.to_thread(
+            emotion_manager.add_emotion,
+            emotion_id=f"{image_stem}_{description_hash}",
+            description=job.description,
+            image_path=image_url,
+            source="ai-generated",
+            embedding=embedding,
+            category=job.category
+        )
+        avatar_index.add(job.description, image_url)
+
+        self.active.pop(job.id, None)
+        async with AsyncSessionLocal() as db:
+            # The status change comes first, so the waiter list read in the same
+            # transaction is final: joins after it find the job done (see join())
+            await db.execute(
+                update(models.AvatarJob)
+                .where(models.AvatarJob.id == job.id)
+                .values(status="done", claimed_by=None, lease_until=None, image_url=image_url, error=None)
+                .execution_options(synchronize_session=False)
+            )
+            session_ids = await db.scalar(select(models.AvatarJob.session_ids).where(models.AvatarJob.id == job.id))
+            await db.commit()
+        waiting = list(dict.fromkeys(json.loads(session_ids)))
+
+        for session_id in waiting:
+            try:
+                await self.notify(session_id, image_url)
+            except Exception as e:
+                report_error("avatar_generation", f"Error notifying {session_id} of avatar update: {e}")
+
+    async def requeue(self, job: models.AvatarJob):
+        async with AsyncSessionLocal() as db:
+            await db.execute(
+                update(models.AvatarJob)
+                .where(models.AvatarJob.id == job.id)
+                .values(
+                    status="queued",
+                    attempts=models.AvatarJob.attempts - 1,
+                    claimed_by=None,
+                    lease_until=None,
+                    available_at=datetime.utcnow()
+                )
+                .execution_options(synchronize_session=False)
+            )
+            await db.commit()
+        self.wakeup.set()
+
+    async def fail(self, job: models.AvatarJob, error: str):
+        self.failures += 1
+        async with AsyncSessionLocal() as db:
+            db_job = await db.get(models.AvatarJob, job.id)
+            db_job.error = error
+            db_job.claimed_by = None
+            db_job.lease_until = None
+            if db_job.attempts < self.max_attempts:
+                # Back off linearly with the number of attempts so far
+                db_job.status = "queued"
+                db_job.available_at = datetime.utcnow() + timedelta(seconds=self.retry_delay * db_job.attempts)
+            else:
+                db_job.status = "failed"
+                self.active.pop(job.id, None)
+            await db.commit()
+        report_error("avatar_generation", f"Avatar job {job.id} failed (attempt {job.attempts}): {error}")
+
+    async def gc_loop(self):
+        while True:
+            await asyncio.sleep(settings.AVATAR_GC_INTERVAL_SECONDS)
+            try:
+                removed = await asyncio.to_thread(self.collect_garbage)
+                self.removed_files += removed
+                if removed:
+                    report_event("avatar_generation", f"Removed {removed} unreferenced generated avatars")
+            except Exception as e:
+                report_error("avatar_generation", f"Error collecting unused avatars: {e}")
+
+    def collect_garbage(self) -> int:
+        # A generated avatar is in use while the avatar collection points at it; jobs that
+        # just finished are covered by the minimum age
+        results = emotion_manager.get_collection().get(include=["metadatas"])
+        referenced = {meta.get("image_path") for meta in results["metadatas"] or []}
+        return image_generator.collect_garbage(referenced, settings.AVATAR_GC_MIN_AGE_SECONDS)
+
+    async def job_status(self, job_id: int):
+        async with AsyncSessionLocal() as db:
+            job = await db.get(models.AvatarJob, job_id)
+            if not job:
+                return None
+            return {
+                "job_id": job.id,
+                "status": job.status,
+                "position": await self.position(db, job),
+                "attempts": job.attempts,
+                "avatar_url": image_generator.public_url(job.image_url) if job.image_url else None,
+                "avatar_thumb_url": image_generator.public_url(job.image_url, "thumb") if job.image_url else None,
+                "error": job.error
+            }
+
+    async def stats(self) -> dict:
+        async with AsyncSessionLocal() as db:
+            rows = (await db.execute(
+                select(models.AvatarJob.status, func.count()).group_by(models.AvatarJob.status)
+            )).all()
+        return {
+            "jobs": {status: count for status, count in rows},
+            "workers": self.worker_count,
+            "generations": self.generations,
+            "coalesced_requests": self.coalesced,
+            "rejected_requests": self.rejected,
+            "failures": self.failures
+        }
+
+avatar_generation = AvatarGeneration()
+
+registry.register(CounterView("avatar_generations_total", "Avatar generations started", lambda: avatar_generation.generations))
+registry.register(CounterView("avatar_requests_total", "Avatar requests that joined an active job or were turned away", lambda: {
+    "coalesced": avatar_generation.coalesced,
+    "rejected": avatar_generation.rejected
+}, label="outcome"))
+registry.register(CounterView("avatar_job_failures_total", "Failed avatar generation attempts", lambda: avatar_generation.failures))
+registry.register(CounterView("avatar_gc_removed_total", "Unreferenced generated avatars deleted", lambda: avatar_generation.removed_files))
+registry.register(Gauge("avatar_jobs_active", "Avatar jobs queued or running", collect=lambda: len(avatar_generation.active)))
@@ -0,0 +1,194 @@
+import asyncio
+import re
+import threading
+from collections import OrderedDict, deque
+from app.core.config import settings
+from app.core.metrics import registry, Counter, Gauge, Histogram, report_event
+from app.services.emotion_manager import emotion_manager
+from app.services.embedding_service import embedding_service
+
+# Seeded avatars for the base categories, used until the collection says otherwise
+BASE_CATEGORY_AVATARS = {
+    "happy": "/static/avatars/happy_01.png",
+    "sad": "/static/avatars/sad_01.png",
+    "angry": "/static/avatars/angry_01.png",
+    "confused": "/static/avatars/confused_01.png",
+    "neutral": "/static/avatars/neutral_01.png"
+}
+
+DISTANCE_BUCKETS = (0.1, 0.2, 0.4, 0.6, 0.8, 1.0, 1.2, 1.4, 1.6, 2.0)
+# Searched lookups kept with their distances for GET /api/v1/stats/avatar-matches
+RECENT_DECISIONS = 50
+
+match_decisions = registry.register(Counter(
+    "avatar_match_decisions_total", "Avatar lookups by outcome: category, cached, reuse or generate", ("decision",)
+))
+match_scores = registry.register(Histogram(
+    "avatar_match_score", "Reranked distance of the best stored avatar for searched descriptions, by outcome and that avatar's category",
+    ("decision", "category"), DISTANCE_BUCKETS
+))
+
+def normalize_description(description: str) -> str:
+    # "A warm, friendly smile!" and "a warm friendly smile" are the same lookup
+    return " ".join(re.sub(r"[^\w\s]", " ", description.lower()).split())
+
+def candidate_category(emotion_id: str, meta: dict):
+    # Seeded ids look like "happy_01", generated ones carry their category in metadata
+    return meta.get("category") or (emotion_id.split("_")[0] if meta.get("source") == "pre-seeded" else None)
+
+class AvatarIndex:
+    # In-memory view of the avatar_emotions collection. Category hits and repeated
+    # descriptions resolve from memory, only new descriptions pay for an embedding and
+    # a vector search.
+    def __init__(self):
+        self.categories: dict[str, str] = dict(BASE_CATEGORY_AVATARS)
+        self.matches: OrderedDict[str, dict] = OrderedDict()
+        self.cache_size = settings.AVATAR_CACHE_SIZE
+        self.threshold = settings.AVATAR_MATCH_THRESHOLD
+        self.category_thresholds = settings.AVATAR_MATCH_THRESHOLDS
+        self.top_k = settings.AVATAR_MATCH_TOP_K
+        self.word_weight = settings.AVATAR_RERANK_WORD_WEIGHT
+        self.decisions = {"category": 0, "cached": 0, "reuse": 0, "generate": 0}
+        self.recent: deque = deque(maxlen=RECENT_DECISIONS)
+        self.loaded = False
+        self.load_lock = threading.Lock()
+
+    def load(self):
+        # Built once, by the startup warm-up or the first lookup, from the seeded avatars
+        # stored in Chroma. Generated avatars never stand in for a whole category: they
+        # were made for one description and are only found through the similarity search.
+        with self.load_lock:
+            if self.loaded:
+                return
+            results = emotion_manager.get_collection().get(include=["metadatas"])
+            for emotion_id, meta in zip(results["ids"], results["metadatas"] or []):
+                category = candidate_category(emotion_id, meta)
+                if category and meta.get("image_path") and meta.get("source") == "pre-seeded":
+                    self.add_category(category, meta["image_path"])
+            self.loaded = True
+        report_event("avatar_index", f"Loaded {len(self.categories)} categories from {len(results['ids'])} emotions")
+
+    def add_category(self, category: str, image_path: str):
+        self.categories[category.lower()] = image_path
+
+    def remember(self, description: str, match: dict):
+        key = normalize_description(description)
+        self.matches[key] = match
+        self.matches.move_to_end(key)
+        while len(self.matches) > self.cache_size:
+            self.matches.popitem(last=False)
+
+    def threshold_for(self, category: str) -> float:
+        return self.category_thresholds.get((category or "").lower(), self.threshold)
+
+    def category_label(self, category: str) -> str:
+        # Categories come from the model's replies, so only the seeded ones and those with
+        # their own threshold get a label of their own on /metrics
+        category = (category or "").lower()
+        if not category:
+            return "none"
+        if category in BASE_CATEGORY_AVATARS or category in self.category_thresholds:
+            return category
+        return "other"
+
+    def rerank(self, description: str, candidates: list[dict]) -> list[dict]:
+        # The embedding distance shrunk by the share of words the two descriptions have in
+        # common (Jaccard), which separates candidates the embedding puts at similar
+        # distances. Costs a set intersection per candidate.
+        words = set(normalize_description(description).split())
+        for candidate in candidates:
+            other = set(normalize_description(candidate["description"] or "").split())
+            overlap = len(words & other) / len(words | other) if words | other else 0.0
+            candidate["score"] = candidate["distance"] * (1 - self.word_weight * overlap)
+            candidate["category"] = candidate_category(candidate["id"], candidate["metadata"])
+        return sorted(candidates, key=lambda candidate: candidate["score"])
+
+    def decide(self, description: str, candidates: list[dict]):
+        # Best reranked candidate that is within the threshold of its own category
+        ranked = self.rerank(description, candidates)
+        for candidate in ranked:
+            if candidate["score"] < self.threshold_for(candidate["category"]):
+                return candidate, ranked
+        return None, ranked
+
+    def record(self, decision: str, description: str = None, best: dict = None, candidates: int = 0):
+        # Counted on /metrics; searched lookups also keep their distances, which is what
+        # the per-category thresholds are tuned from
+        self.decisions[decision] += 1
+        match_decisions.inc(decision=decision)
+        if description is None:
+            return
+        if best is not None:
+            match_scores.observe(best["score"], decision=decision, category=self.category_label(best["category"]))
+        self.recent.append({
+            "decision": decision,
+            "description": description,
+            "best": best["id"] if best else None,
+            "category": best["category"] if best else None,
+            "distance": best["distance"] if best else None,
+            "score": best["score"] if best else None,
+            "threshold": self.threshold_for(best["category"]) if best else None,
+            "candidates": candidates
+        })
+        if settings.AVATAR_LOG_DECISIONS:
+            if best is None:
+                report_event("avatar_index", f"{decision} {description!r}: no stored avatars")
+            else:
+                report_event(
+                    "avatar_index",
+                    f"{decision} {description!r}: best={best['id']} category={best['category']} "
+                    f"distance={best['distance']:.3f} score={best['score']:.3f} "
+                    f"threshold={self.threshold_for(best['category'])} candidates={candidates}"
+                )
+
+    async def resolve(self, category: str, description: str):
+        # Returns (image_path, embedding). image_path is None when nothing is close enough,
+        # embedding is only set when the description had to be embedded for the search, so
+        # the caller can reuse it when the new avatar is added.
+        if not self.loaded:
+            await asyncio.to_thread(self.load)
+        if category in self.categories:
+            self.record("category")
+            return self.categories[category], None
+
+        key = normalize_description(description)
+        if key in self.matches:
+            self.matches.move_to_end(key)
+            self.record("cached")
+            return self.matches[key]["image_path"], None
+
+        embedding = (await embedding_service.aembed([description]))[0]
+        candidates = await asyncio.to_thread(emotion_manager.get_candidates, description, self.top_k, embedding)
+        match, ranked = self.decide(description, candidates)
+        if match is None:
+            self.remember(description, {"image_path": None, "distance": ranked[0]["distance"] if ranked else None})
+            self.record("generate", description, ranked[0] if ranked else None, len(ranked))
+            return None, embedding
+        self.remember(description, {"image_path": match["metadata"]["image_path"], "distance": match["distance"]})
+        self.record("reuse", description, match, len(ranked))
+        return match["metadata"]["image_path"], embedding
+
+    def add(self, description: str, image_path: str):
+        # Called after a generated avatar has been stored in Chroma; it is reused for this
+        # description and for others close enough to it, not for its whole category
+        self.remember(description, {"image_path": image_path, "distance": 0.0})
+        # Cached misses may now be close enough to the new avatar, look them up again
+        for key in [key for key, match in self.matches.items() if match["image_path"] is None]:
+            del self.matches[key]
+
+    def stats(self) -> dict:
+        searched = self.decisions["reuse"] + self.decisions["generate"]
+        return {
+            "decisions": dict(self.decisions),
+            "reuse_rate": self.decisions["reuse"] / searched if searched else 0.0,
+            "threshold": self.threshold,
+            "category_thresholds": self.category_thresholds,
+            "top_k": self.top_k,
+            "word_weight": self.word_weight,
+            "cached_descriptions": len(self.matches),
+            "recent": list(self.recent)
+        }
+
+avatar_index = AvatarIndex()
+
+registry.register(Gauge("avatar_index_categories", "Categories answered from the in-memory avatar index", collect=lambda: len(avatar_index.categories)))
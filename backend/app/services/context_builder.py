@@ -0,0 +1,113 @@
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.core.config import settings
+from app.core.database import AsyncSessionLocal
+from app import models
+from app.services.history_manager import history_manager
+from app.services.gemini_service import gemini_service
+
+EMPTY_CONTEXT = "No prior questions. This is the start of the conversation."
+
+def estimate_tokens(text: str) -> int:
+    # Roughly four characters per token for English text, close enough for budgeting
+    return len(text) // 4 + 1
+
+def truncate_to_tokens(text: str, tokens: int) -> str:
+    return text[:max(tokens, 0) * 4]
+
+class ContextBuilder:
+    # Assembles the prompt context for one turn from the session summary, the most recent
+    # exchanges and semantically similar older exchanges, within a fixed token budget.
+    def __init__(self):
+        self.token_budget = settings.CONTEXT_TOKEN_BUDGET
+        self.recent_turns = settings.CONTEXT_RECENT_TURNS
+        self.semantic_top_k = settings.CONTEXT_SEMANTIC_TOP_K
+        self.summary_trigger = settings.SUMMARY_TRIGGER_MESSAGES
+        # Sessions with a summary update in flight, so back-to-back turns don't summarize twice
+        self.summarizing: set[str] = set()
+
+    async def build(self, db: AsyncSession, db_session: models.ChatSession, query_embedding) -> str:
+        recent = await history_manager.recent_exchanges(db, db_session.id, self.recent_turns)
+        similar = [
+            exchange for exchange in await history_manager.search_exchanges(db, db_session.id, query_embedding, self.semantic_top_k)
+            if exchange not in recent
+        ]
+        budget = self.token_budget
+
+        # Newest turns matter most, keep as many as fit, newest first
+        kept_recent = []
+        for exchange in reversed(recent):
+            cost = estimate_tokens(exchange)
+            if cost > budget:
+                break
+            kept_recent.insert(0, exchange)
+            budget -= cost
+
+        summary = db_session.summary or ""
+        if summary:
+            summary = truncate_to_tokens(summary, budget) if estimate_tokens(summary) > budget else summary
+            budget -= estimate_tokens(summary)
+
+        # Semantic hits fill what is left, best match first
+        kept_similar = []
+        for exchange in similar:
+            cost = estimate_tokens(exchange)
+            if cost > budget:
+                break
+            kept_similar.append(exchange)
+            budget -= cost
+
+        sections = []
+        if summary:
+            sections.append(f"Summary of the earlier conversation:\n{summary}")
+        if kept_similar:
+            sections.append("Related earlier exchanges:\n" + "\n\n".join(kept_similar))
+        if kept_recent:
+            sections.append("Most recent exchanges:\n" + "\n\n".join(kept_recent))
+        return "\n\n".join(sections) if sections else EMPTY_CONTEXT
+
+    async def update_summary(self, session_id: str):
+        # Runs after the turn has been answered, so summarizing never adds to reply latency.
+        # Messages older than the recent window are folded into the summary once enough
+        # of them have piled up since the last update.
+        if session_id in self.summarizing:
+            return
+        self.summarizing.add(session_id)
+        try:
+            async with AsyncSessionLocal() as db:
+                await self.summarize_aged_out(db, session_id)
+        finally:
+            self.summarizing.discard(session_id)
+
+    async def summarize_aged_out(self, db: AsyncSession, session_id: str):
+        db_session = await db.get(models.ChatSession, session_id)
+        if not db_session:
+            return
+        upto = db_session.summary_upto_message_id or 0
+
+        result = await db.execute(
+            select(models.ChatMessage)
+            .where(models.ChatMessage.session_id == session_id, models.ChatMessage.id > upto)
+            .order_by(models.ChatMessage.timestamp, models.ChatMessage.id)
+        )
+        pending = result.scalars().all()
+        # Leave the recent window alone, it is sent verbatim
+        aged_out = pending[:-self.recent_turns * 2] if self.recent_turns else pending
+        if len(aged_out) < self.summary_trigger:
+            return
+        # Never split an exchange between the summary and the recent window
+        if aged_out[-1].sender == "user":
+            aged_out = aged_out[:-1]
+        if not aged_out:
+            return
+
+        transcript = "\n\n".join(history_manager.pair_exchanges(aged_out))
+        # End the read transaction so the Gemini call doesn't hold it open
+        await db.commit()
+        summary = await gemini_service.summarize(db_session.summary, transcript)
+        if summary:
+            db_session.summary = summary
+            db_session.summary_upto_message_id = aged_out[-1].id
+            await db.commit()
+
+context_builder = ContextBuilder()
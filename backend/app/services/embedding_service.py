@@ -0,0 +1,178 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from chromadb import Documents, EmbeddingFunction, Embeddings
+from app.core.config import settings
+from app.core.metrics import registry, CounterView, Gauge, report_event
+
+class EmbeddingService:
+    # One SentenceTransformer per worker, shared by every Chroma collection.
+    # The model is loaded on first use, concurrent callers are coalesced into one
+    # encode() call and repeated texts are served from an LRU cache.
+    def __init__(self, model_name: str = "all-MiniLM-L6-v2"):
+        self.model_name = model_name
+        self.model = None
+        self.load_lock = threading.Lock()
+
+        self.cache: OrderedDict[str, list] = OrderedDict()
+        self.cache_size = settings.EMBEDDING_CACHE_SIZE
+        self.batch_window = settings.EMBEDDING_BATCH_WINDOW_MS / 1000
+
+        # Texts waiting for the next batch, each with the future its caller is blocked on
+        self.pending: list[tuple[str, Future]] = []
+        # Every text queued or being encoded, so concurrent callers share one future
+        self.inflight: dict[str, Future] = {}
+        self.pending_lock = threading.Lock()
+        self.leader_active = False
+
+        # Stats
+        self.load_time = None
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.batch_count = 0
+        self.batched_texts = 0
+        self.max_batch_size = 0
+
+    def get_model(self):
+        if self.model is None:
+            with self.load_lock:
+                if self.model is None:
+                    from sentence_transformers import SentenceTransformer
+                    start = time.perf_counter()
+                    self.model = SentenceTransformer(self.model_name)
+                    self.load_time = time.perf_counter() - start
+                    report_event("embedding", f"Loaded embedding model {self.model_name} in {self.load_time:.2f}s")
+        return self.model
+
+    def enqueue(self, texts: list[str]):
+        # Serves cache hits and queues the rest; returns (results, [(index, future)], leader)
+        # where the caller that gets leader=True is responsible for running the batch
+        results: list = [None] * len(texts)
+        waiting: list[tuple[int, Future]] = []
+        become_leader = False
+
+        with self.pending_lock:
+            for i, text in enumerate(texts):
+                if text in self.cache:
+                    self.cache.move_to_end(text)
+                    results[i] = self.cache[text]
+                    self.cache_hits += 1
+                    continue
+                self.cache_misses += 1
+                if text not in self.inflight:
+                    self.inflight[text] = Future()
+                    self.pending.append((text, self.inflight[text]))
+                waiting.append((i, self.inflight[text]))
+            if self.pending and not self.leader_active:
+                self.leader_active = True
+                become_leader = True
+        return results, waiting, become_leader
+
+    def embed(self, texts: list[str]) -> list[list[float]]:
+        # Blocking variant for sync callers (Chroma's embedding function, scripts); async
+        # code uses aembed() so the event loop never waits on the batch window or the model
+        results, waiting, become_leader = self.enqueue(texts)
+        if become_leader:
+            self.run_batch()
+        for i, future in waiting:
+            results[i] = future.result()
+        return results
+
+    async def aembed(self, texts: list[str]) -> list[list[float]]:
+        results, waiting, become_leader = self.enqueue(texts)
+        if become_leader:
+            # The batch carries other callers' texts, so it runs to the end even when this
+            # caller is cancelled (client disconnects cancel the request handler)
+            await asyncio.shield(self.lead_batch())
+        for i, future in waiting:
+            # Shielded so a cancelled caller does not cancel the future it shares with others
+            results[i] = await asyncio.shield(asyncio.wrap_future(future))
+        return results
+
+    async def lead_batch(self):
+        # The batch window passes on the event loop, so other requests can join the batch
+        # meanwhile; only the model call itself runs in a thread
+        try:
+            if self.batch_window:
+                await asyncio.sleep(self.batch_window)
+        finally:
+            await asyncio.to_thread(self.encode_pending)
+
+    def run_batch(self):
+        # Give other callers a moment to join, then encode everything pending at once
+        if self.batch_window:
+            time.sleep(self.batch_window)
+        self.encode_pending()
+
+    def encode_pending(self):
+        with self.pending_lock:
+            batch = self.pending
+            self.pending = []
+
+        by_text = None
+        try:
+            texts = [text for text, _ in batch]
+            vectors = self.get_model().encode(texts, convert_to_numpy=True)
+            by_text = {text: vector.tolist() for text, vector in zip(texts, vectors)}
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+        finally:
+            with self.pending_lock:
+                for text, _ in batch:
+                    self.inflight.pop(text, None)
+                if by_text is not None:
+                    self.batch_count += 1
+                    self.batched_texts += len(by_text)
+                    self.max_batch_size = max(self.max_batch_size, len(by_text))
+                    for text, vector in by_text.items():
+                        self.cache[text] = vector
+                        self.cache.move_to_end(text)
+                    while len(self.cache) > self.cache_size:
+                        self.cache.popitem(last=False)
+                # Callers that arrived while encoding are picked up by the next leader
+                if self.pending:
+                    threading.Thread(target=self.run_batch, daemon=True).start()
+                else:
+                    self.leader_active = False
+
+        if by_text is not None:
+            for text, future in batch:
+                # A future is only done here if a waiter cancelled it
+                if not future.done():
+                    future.set_result(by_text[text])
+
+    def stats(self) -> dict:
+        lookups = self.cache_hits + self.cache_misses
+        return {
+            "model_name": self.model_name,
+            "loaded": self.model is not None,
+            "load_time_seconds": self.load_time,
+            "cache_size": len(self.cache),
+            "cache_hits": self.cache_hits,
+            "cache_misses": self.cache_misses,
+            "cache_hit_rate": self.cache_hits / lookups if lookups else 0.0,
+            "batch_count": self.batch_count,
+            "avg_batch_size": self.batched_texts / self.batch_count if self.batch_count else 0.0,
+            "max_batch_size": self.max_batch_size
+        }
+
+class SharedEmbeddingFunction(EmbeddingFunction):
+    # Chroma adapter so collections embed documents and queries through the shared service
+    def __init__(self, service: EmbeddingService):
+        self.service = service
+
+    def __call__(self, input: Documents) -> Embeddings:
+        return self.service.embed(list(input))
+
+embedding_service = EmbeddingService()
+embedding_function = SharedEmbeddingFunction(embedding_service)
+
+registry.register(CounterView("embedding_cache_lookups_total", "Embedding cache lookups by result", lambda: {
+    "hit": embedding_service.cache_hits,
+    "miss": embedding_service.cache_misses
+}, label="result"))
+registry.register(Gauge("embedding_model_load_seconds", "Time it took to load the embedding model, 0 until loaded", collect=lambda: embedding_service.load_time or 0))
@@ -1,37 +1,59 @@
 import chromadb
-from chromadb.utils import embedding_functions
 from app.core.config import settings
+from app.services.embedding_service import embedding_function
 import os
+import threading
 
 class EmotionManager:
     def __init__(self):
-        self.client = chromadb.PersistentClient(path=os.path.join(settings.BASE_DIR, "chroma_db"))
-        self.embedding_function = embedding_functions.SentenceTransformerEmbeddingFunction(model_name="all-MiniLM-L6-v2")
-        self.collection = self.client.get_or_create_collection(
-            name="avatar_emotions",
-            embedding_function=self.embedding_function
-        )
+        # The store is opened on first use, so importing this module stays cheap
+        self.client = None
+        self.collection = None
+        self.embedding_function = embedding_function
+        self.open_lock = threading.Lock()
+
+    def get_collection(self):
+        if self.collection is None:
+            with self.open_lock:
+                if self.collection is None:
+                    self.client = chromadb.PersistentClient(path=os.path.join(settings.DATA_DIR, "chroma_db"))
+                    self.collection = self.client.get_or_create_collection(
+                        name="avatar_emotions",
+                        embedding_function=self.embedding_function
+                    )
+        return self.collection
 
-    def add_emotion(self, emotion_id: str, description: str, image_path: str, source: str = "pre-seeded"):
-        self.collection.add(
+    def add_emotion(self, emotion_id: str, description: str, image_path: str, source: str = "pre-seeded", embedding=None, category: str = None):
+        metadata = {"image_path": image_path, "source": source}
+        if category:
+            metadata["category"] = category
+        # upsert, so registering the same (content-addressed) avatar twice is harmless
+        self.get_collection().upsert(
             documents=[description],
-            metadatas=[{"image_path": image_path, "source": source}],
+            embeddings=[embedding] if embedding is not None else None,
+            metadatas=[metadata],
             ids=[emotion_id]
         )
 
-    def get_best_emotion(self, description: str, n_results: int = 1):
-        results = self.collection.query(
-            query_texts=[description],
-            n_results=n_results
-        )
-        
-        if results['ids'] and results['ids'][0]:
-            # Return the best match
-            return {
-                "id": results['ids'][0][0],
-                "distance": results['distances'][0][0] if 'distances' in results else 0,
-                "metadata": results['metadatas'][0][0]
-            }
-        return None
+    def get_candidates(self, description: str, n_results: int = 5, embedding=None) -> list[dict]:
+        # Nearest stored avatars, closest first, with their description and metadata
+        if embedding is not None:
+            results = self.get_collection().query(query_embeddings=[embedding], n_results=n_results)
+        else:
+            results = self.get_collection().query(query_texts=[description], n_results=n_results)
+
+        if not results['ids'] or not results['ids'][0]:
+            return []
+        distances = results['distances'][0] if results.get('distances') else [0] * len(results['ids'][0])
+        documents = results['documents'][0] if results.get('documents') else [None] * len(results['ids'][0])
+        return [
+            {"id": emotion_id, "distance": distance, "description": document, "metadata": metadata}
+            for emotion_id, distance, document, metadata in zip(results['ids'][0], distances, documents, results['metadatas'][0])
+        ]
+
+    def get_best_emotion(self, description: str, n_results: int = 1, embedding=None):
+        candidates = self.get_candidates(description, n_results, embedding)
+        # Return the best match
+        return candidates[0] if candidates else None
 
 emotion_manager = EmotionManager()
@@ -1,21 +1,119 @@
 import google.generativeai as genai
 from app.core.config import settings
+from app.core.metrics import registry, Counter, report_error
+import asyncio
 import json
+import re
 
 if settings.GEMINI_API_KEY:
     genai.configure(api_key=settings.GEMINI_API_KEY)
 
-class GeminiService:
+FALLBACK_RESPONSE = {"reply_text": "I'm having trouble thinking right now.", "emotion_description": "confused", "emotion_category": "confused"}
+NO_KEY_RESPONSE = {"reply_text": "Gemini API Key not configured.", "emotion_description": "neutral", "emotion_category": "neutral"}
+
+gemini_calls = registry.register(Counter("gemini_calls_total", "Gemini calls by kind and outcome", ("kind", "outcome")))
+gemini_retries = registry.register(Counter("gemini_retries_total", "Gemini calls retried after a transient error"))
+
+# Rate limiting and transient server errors are worth another attempt, anything else is not
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+def is_retryable(error: Exception) -> bool:
+    if isinstance(error, asyncio.TimeoutError):
+        return True
+    # google.api_core exceptions carry the HTTP status in `code`
+    code = getattr(error, "code", None)
+    try:
+        return int(code) in RETRYABLE_STATUS_CODES
+    except (TypeError, ValueError):
+        return False
+
+class ReplyTextExtractor:
+    # Pulls the "reply_text" string value out of a JSON document that arrives in pieces,
+    # so the reply can be forwarded before the rest of the object has been generated.
+    KEY_PATTERN = re.compile(r'"reply_text"\s*:\s*"')
+
     def __init__(self):
+        self.buffer = ""
+        self.start = None
+        self.pos = None
+        self.done = False
+
+    def feed(self, chunk: str) -> str:
+        self.buffer += chunk
+        if self.done:
+            return ""
+        if self.start is None:
+            match = self.KEY_PATTERN.search(self.buffer)
+            if not match:
+                return ""
+            self.start = self.pos = match.end()
+
+        # Only decode up to the last complete character or escape sequence
+        raw_end = self.pos
+        i = self.pos
+        while i < len(self.buffer):
+            ch = self.buffer[i]
+            if ch == '"':
+                self.done = True
+                break
+            if ch == "\\":
+                if i + 1 >= len(self.buffer):
+                    break
+                if self.buffer[i + 1] == "u":
+                    if i + 6 > len(self.buffer):
+                        break
+                    # A high surrogate must be decoded together with its low surrogate
+                    if 0xD800 <= int(self.buffer[i + 2:i + 6], 16) <= 0xDBFF:
+                        if i + 12 > len(self.buffer):
+                            break
+                        i += 12
+                    else:
+                        i += 6
+                else:
+                    i += 2
+            else:
+                i += 1
+            raw_end = i
+
+        piece = json.loads(f'"{self.buffer[self.pos:raw_end]}"')
+        self.pos = raw_end
+        return piece
+
+class GeminiService:
+    def __init__(self, model=None):
         # Using gemini-1.5-flash as a stable alternative to the requested gemini-2.5-pro
         self.model_name = 'gemini-2.5-flash' 
-        self.model = genai.GenerativeModel(self.model_name)
+        # Any object with an async generate_content_async() can stand in for the real model,
+        # which lets the service be exercised against a local fake without an API key
+        self.enabled = model is not None or bool(settings.GEMINI_API_KEY)
+        self.model = model or genai.GenerativeModel(self.model_name)
+        # Bounds the number of in-flight Gemini calls per worker
+        self.semaphore = asyncio.Semaphore(settings.GEMINI_MAX_CONCURRENCY)
 
-    async def generate_response(self, user_message: str, context: str = ""):
-        if not settings.GEMINI_API_KEY:
-            return {"reply_text": "Gemini API Key not configured.", "emotion_description": "neutral", "emotion_category": "neutral"}
-            
-        prompt = f"""
+    async def call_with_retry(self, prompt: str, **kwargs):
+        # Runs on the SDK's async client so a slow completion never blocks the event loop
+        attempt = 0
+        while True:
+            try:
+                return await asyncio.wait_for(
+                    self.model.generate_content_async(
+                        prompt,
+                        generation_config={"response_mime_type": "application/json"},
+                        **kwargs
+                    ),
+                    timeout=settings.GEMINI_TIMEOUT_SECONDS
+                )
+            except Exception as e:
+                if attempt >= settings.GEMINI_MAX_RETRIES or not is_retryable(e):
+                    raise
+                delay = settings.GEMINI_RETRY_BACKOFF_SECONDS * (2 ** attempt)
+                gemini_retries.inc()
+                report_error("gemini", f"call failed ({e}), retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+                attempt += 1
+
+    def build_prompt(self, user_message: str, context: str = ""):
+        return f"""
         You are a helpful chatbot. 
         
         Context from previous conversation:
@@ -32,17 +130,118 @@ class GeminiService:
         
         User message: {user_message}
         """
+
+    async def generate_response(self, user_message: str, context: str = ""):
+        if not self.enabled:
+            return dict(NO_KEY_RESPONSE)
+            
+        prompt = self.build_prompt(user_message, context)
         
         try:
             # Force JSON response if supported by the model/API, or just prompt engineering
             # Gemini 1.5 supports response_mime_type="application/json"
-            response = self.model.generate_content(
-                prompt,
-                generation_config={"response_mime_type": "application/json"}
-            )
-            return json.loads(response.text)
+            async with self.semaphore:
+                response = await self.call_with_retry(prompt)
+            result = json.loads(response.text)
+            gemini_calls.inc(kind="response", outcome="ok")
+            return result
+        except Exception as e:
+            gemini_calls.inc(kind="response", outcome="error")
+            report_error("gemini", f"Error generating response: {e}")
+            return dict(FALLBACK_RESPONSE)
+
+    async def summarize(self, previous_summary: str, transcript: str):
+        # Folds new turns into the running session summary, returns None if it could not be updated
+        if not self.enabled:
+            return None
+
+        prompt = f"""
+        Update the running summary of a conversation between a user and a chatbot.
+        Keep facts, names, preferences and open questions; drop small talk.
+        Keep it under 200 words.
+
+        Current summary:
+        {previous_summary or "(none)"}
+
+        New turns:
+        {transcript}
+
+        Return JSON with a single key "summary".
+        """
+
+        try:
+            async with self.semaphore:
+                response = await self.call_with_retry(prompt)
+            summary = json.loads(response.text).get("summary")
+            gemini_calls.inc(kind="summary", outcome="ok")
+            return summary
+        except Exception as e:
+            gemini_calls.inc(kind="summary", outcome="error")
+            report_error("gemini", f"Error updating summary: {e}")
+            return None
+
+    async def stream_response(self, user_message: str, context: str = ""):
+        # Yields {"type": "token", "text": ...} events while the reply is generated,
+        # followed by a single {"type": "result", ...} event with the parsed response.
+        if not self.enabled:
+            result = dict(NO_KEY_RESPONSE)
+            yield {"type": "token", "text": result["reply_text"]}
+            yield {"type": "result", **result}
+            return
+
+        prompt = self.build_prompt(user_message, context)
+        extractor = ReplyTextExtractor()
+        streamed = ""
+        # The upstream stream is read by its own task, so the concurrency slot is released
+        # as soon as Gemini is done rather than when a slow client has read every event
+        chunks = asyncio.Queue()
+        reader = asyncio.create_task(self.read_stream(prompt, chunks))
+
+        try:
+            try:
+                while True:
+                    chunk = await chunks.get()
+                    if chunk is None:
+                        break
+                    if isinstance(chunk, Exception):
+                        raise chunk
+                    piece = extractor.feed(chunk)
+                    if piece:
+                        streamed += piece
+                        yield {"type": "token", "text": piece}
+                result = json.loads(extractor.buffer)
+                gemini_calls.inc(kind="stream", outcome="ok")
+            except Exception as e:
+                gemini_calls.inc(kind="stream", outcome="error")
+                report_error("gemini", f"Error streaming response: {e}")
+                if streamed:
+                    # Keep what the user has already seen, the emotion fields are lost
+                    result = {"reply_text": streamed, "emotion_description": "neutral", "emotion_category": "neutral", "truncated": True}
+                else:
+                    result = dict(FALLBACK_RESPONSE)
+                    yield {"type": "token", "text": result["reply_text"]}
+
+            yield {"type": "result", **result}
+        finally:
+            # Stops the upstream call when the client went away mid-stream
+            reader.cancel()
+
+    async def read_stream(self, prompt: str, chunks: asyncio.Queue):
+        # Puts the text of each streamed chunk on `chunks`, then None when the stream is
+        # complete or the exception that ended it
+        try:
+            async with self.semaphore:
+                # Retries are only safe before anything has been sent to the client
+                response = await self.call_with_retry(prompt, stream=True)
+                stream = response.__aiter__()
+                while True:
+                    try:
+                        chunk = await asyncio.wait_for(stream.__anext__(), timeout=settings.GEMINI_TIMEOUT_SECONDS)
+                    except StopAsyncIteration:
+                        break
+                    chunks.put_nowait(chunk.text)
+            chunks.put_nowait(None)
         except Exception as e:
-            print(f"Error generating response: {e}")
-            return {"reply_text": "I'm having trouble thinking right now.", "emotion_description": "confused", "emotion_category": "confused"}
+            chunks.put_nowait(e)
 
 gemini_service = GeminiService()
@@ -1,71 +1,266 @@
+import asyncio
 import chromadb
-from chromadb.utils import embedding_functions
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from app.core.config import settings
+from app import models
+from app.services.embedding_service import embedding_function, embedding_service
+import hashlib
 import os
-import uuid
+import threading
+
+LEGACY_COLLECTION = "chat_history"
+# Empty collection whose metadata records how many shards the store was built with
+SHARD_MARKER_COLLECTION = "chat_history_shards"
 
 class HistoryManager:
     def __init__(self):
-        # Use a separate path for history as requested
-        self.client = chromadb.PersistentClient(path=os.path.join(settings.BASE_DIR, "chroma_history_db"))
-        self.embedding_function = embedding_functions.SentenceTransformerEmbeddingFunction(model_name="all-MiniLM-L6-v2")
-        self.collection = self.client.get_or_create_collection(
-            name="chat_history",
-            embedding_function=self.embedding_function
-        )
+        # The store is opened on first use, so importing this module stays cheap
+        self.client = None
+        self.shards = None
+        self.embedding_function = embedding_function
+        # History is split over a fixed number of collections by session hash, so a query
+        # only searches the index of its own shard and deleting a session touches one shard
+        self.shard_count = settings.HISTORY_SHARDS
+        self.open_lock = threading.Lock()
+
+    def get_shards(self) -> list:
+        if self.shards is None:
+            client = self.get_client()
+            with self.open_lock:
+                if self.shards is None:
+                    self.shards = [
+                        client.get_or_create_collection(
+                            name=f"{LEGACY_COLLECTION}_{shard:03d}",
+                            embedding_function=self.embedding_function
+                        )
+                        for shard in range(self.shard_count)
+                    ]
+        return self.shards
+
+    def get_client(self):
+        if self.client is None:
+            with self.open_lock:
+                if self.client is None:
+                    # Use a separate path for history as requested
+                    client = chromadb.PersistentClient(path=os.path.join(settings.DATA_DIR, "chroma_history_db"))
+                    self.check_shard_count(client)
+                    self.client = client
+        return self.client
 
-    def store_chat_history(self, session_id: str, question: str, answer: str):
+    def check_shard_count(self, client):
+        # Sessions are mapped to shards modulo the shard count, so with a different count
+        # their history would be looked up in the wrong collection. The count the store
+        # was built with is kept in a marker collection and a different setting is refused.
+        try:
+            marker = client.get_collection(SHARD_MARKER_COLLECTION)
+        except Exception:
+            # Stores from before the marker existed: count the shard collections they have
+            names = [getattr(c, "name", c) for c in client.list_collections()]
+            built = sum(1 for name in names if name.startswith(f"{LEGACY_COLLECTION}_") and name[len(LEGACY_COLLECTION) + 1:].isdigit())
+            marker = client.create_collection(
+                SHARD_MARKER_COLLECTION,
+                metadata={"shard_count": built or self.shard_count},
+                embedding_function=self.embedding_function
+            )
+        stored = marker.metadata["shard_count"]
+        if stored != self.shard_count:
+            raise RuntimeError(
+                f"The chat history store has {stored} shards but HISTORY_SHARDS is {self.shard_count}; "
+                f"set HISTORY_SHARDS={stored} or start from an empty chroma_history_db"
+            )
+
+    def shard_for(self, session_id: str) -> int:
+        # Stable across processes and restarts, unlike hash()
+        digest = hashlib.sha1(session_id.encode()).digest()
+        return int.from_bytes(digest[:4], "big") % self.shard_count
+
+    def collection_for(self, session_id: str):
+        return self.get_shards()[self.shard_for(session_id)]
+
+    @staticmethod
+    def format_question(question: str) -> str:
         # Format similar to reference
-        question_key = f"User: {question}"
-        answer_key = f"AI: {answer}"
-        full_exchange = f"{question_key}\n{answer_key}"
-        
-        # Store both Q and A as searchable documents, but link them via metadata
-        self.collection.add(
-            documents=[question_key, answer_key],
-            metadatas=[
-                {"session_id": session_id, "full_exchange": full_exchange, "type": "question"},
-                {"session_id": session_id, "full_exchange": full_exchange, "type": "answer"}
-            ],
-            ids=[f"{uuid.uuid4()}_q", f"{uuid.uuid4()}_a"]
-        )
+        return f"User: {question}"
+
+    @staticmethod
+    def format_answer(answer: str) -> str:
+        return f"AI: {answer}"
+
+    async def embed_question(self, question: str):
+        # The same vector serves as the retrieval query and as the stored question document
+        return (await embedding_service.aembed([self.format_question(question)]))[0]
+
+    async def store_chat_history(self, session_id: str, question_id: int, answer_id: int, question: str, answer: str, question_embedding=None):
+        # Vectors only point at the ChatMessage rows; the messages table is the single copy
+        # of the text, fetched back in one query by load_exchanges()
+        question_key = self.format_question(question)
+        answer_key = self.format_answer(answer)
 
-    def retrieve_context(self, session_id: str, query: str, top_k: int = 3):
-        results = self.collection.query(
-            query_texts=[query],
+        if question_embedding is None:
+            question_embedding, answer_embedding = await embedding_service.aembed([question_key, answer_key])
+        else:
+            answer_embedding = (await embedding_service.aembed([answer_key]))[0]
+        # Chroma writes are blocking, keep them off the event loop
+        await asyncio.to_thread(self.store_exchanges, [(session_id, question_id, answer_id, question_embedding, answer_embedding)])
+
+    def store_exchanges(self, exchanges: list[tuple]):
+        # (session_id, question_id, answer_id, question_embedding, answer_embedding) tuples,
+        # written with one add() per shard
+        by_shard: dict[int, dict] = {}
+        for session_id, question_id, answer_id, question_embedding, answer_embedding in exchanges:
+            rows = by_shard.setdefault(self.shard_for(session_id), {"ids": [], "embeddings": [], "metadatas": []})
+            # Store both Q and A as searchable vectors, linked to the same exchange
+            exchange = {"session_id": session_id, "question_id": question_id, "answer_id": answer_id}
+            rows["ids"] += [f"msg_{question_id}", f"msg_{answer_id}"]
+            rows["embeddings"] += [question_embedding, answer_embedding]
+            rows["metadatas"] += [{**exchange, "type": "question"}, {**exchange, "type": "answer"}]
+        for shard, rows in by_shard.items():
+            self.get_shards()[shard].add(**rows)
+
+    async def load_exchanges(self, db: AsyncSession, pairs: list[tuple[int, int]]) -> dict:
+        # Batched lookup of (question_id, answer_id) pairs -> formatted exchange text
+        ids = {message_id for pair in pairs for message_id in pair}
+        if not ids:
+            return {}
+        result = await db.execute(select(models.ChatMessage).where(models.ChatMessage.id.in_(ids)))
+        by_id = {m.id: m.content for m in result.scalars().all()}
+        return {
+            (q, a): f"{self.format_question(by_id[q])}\n{self.format_answer(by_id[a])}"
+            for q, a in pairs if q in by_id and a in by_id
+        }
+
+    async def search_exchanges(self, db: AsyncSession, session_id: str, query_embedding, top_k: int = 3) -> list[str]:
+        # The collection is resolved in the thread too: the first call opens the store
+        results = await asyncio.to_thread(lambda: self.collection_for(session_id).query(
+            query_embeddings=[query_embedding],
             n_results=top_k,
-            where={"session_id": session_id}
-        )
+            where={"session_id": session_id},
+            include=["metadatas"]
+        ))
         
-        # Use a set to deduplicate exchanges (in case both Q and A match the query)
-        exchanges = set()
+        # Deduplicate exchanges (in case both Q and A match the query), best match first
+        pairs = []
         if results['metadatas']:
             for meta_list in results['metadatas']:
                 for meta in meta_list:
-                    if 'full_exchange' in meta:
-                        exchanges.add(meta['full_exchange'])
-        
+                    pair = (meta.get('question_id'), meta.get('answer_id'))
+                    if None not in pair and pair not in pairs:
+                        pairs.append(pair)
+        texts = await self.load_exchanges(db, pairs)
+        return [texts[pair] for pair in pairs if pair in texts]
+
+    async def retrieve_context(self, db: AsyncSession, session_id: str, query: str, top_k: int = 3, query_embedding=None):
+        if query_embedding is None:
+            query_embedding = await self.embed_question(query)
+        exchanges = await self.search_exchanges(db, session_id, query_embedding, top_k)
         return "\n\n".join(exchanges) if exchanges else None
 
-    def retrieve_last_n(self, session_id: str, n: int = 3):
-        # Fallback to get some recent history if no semantic match
-        # Using empty query string as a "match all" heuristic similar to reference
-        results = self.collection.query(
-            query_texts=[""],
-            n_results=n * 2, # *2 because we store Q and A separately
-            where={"session_id": session_id}
+    def pair_exchanges(self, messages: list) -> list[str]:
+        # Pair each user message with the bot reply that follows it, in the order given
+        exchanges = []
+        question = None
+        for message in messages:
+            if message.sender == "user":
+                question = message.content
+            elif question is not None:
+                exchanges.append(f"{self.format_question(question)}\n{self.format_answer(message.content)}")
+                question = None
+        return exchanges
+
+    async def recent_exchanges(self, db: AsyncSession, session_id: str, n: int = 3) -> list[str]:
+        # Reads the newest messages through the (session_id, timestamp) index, no embedding needed
+        result = await db.execute(
+            select(models.ChatMessage)
+            .where(models.ChatMessage.session_id == session_id)
+            .order_by(models.ChatMessage.timestamp.desc(), models.ChatMessage.id.desc())
+            .limit(n * 2)
         )
-        
-        exchanges = set()
-        if results['metadatas']:
-            for meta_list in results['metadatas']:
-                for meta in meta_list:
-                    if 'full_exchange' in meta:
-                        exchanges.add(meta['full_exchange'])
-                        
-        if not exchanges:
-            return "No prior questions. This is the start of the conversation."
-            
-        return "\n\n".join(list(exchanges)[-n:])
+        messages = result.scalars().all()
+        return self.pair_exchanges(list(reversed(messages)))[-n:]
+
+    def delete_session(self, session_id: str):
+        self.collection_for(session_id).delete(where={"session_id": session_id})
+
+    def migrate_legacy_collection(self, batch_size: int = 500) -> int:
+        # One-shot move of the single pre-sharding collection into the shards, reusing the
+        # stored embeddings. Returns the number of vectors moved.
+        try:
+            legacy = self.get_client().get_collection(LEGACY_COLLECTION)
+        except Exception:
+            return 0
+
+        moved = 0
+        while True:
+            batch = legacy.get(limit=batch_size, include=["documents", "metadatas", "embeddings"])
+            if not batch["ids"]:
+                break
+            by_shard: dict[int, list[int]] = {}
+            for i, meta in enumerate(batch["metadatas"]):
+                by_shard.setdefault(self.shard_for(meta["session_id"]), []).append(i)
+            for shard, rows in by_shard.items():
+                self.get_shards()[shard].upsert(
+                    ids=[batch["ids"][i] for i in rows],
+                    documents=[batch["documents"][i] for i in rows],
+                    metadatas=[batch["metadatas"][i] for i in rows],
+                    embeddings=[list(batch["embeddings"][i]) for i in rows]
+                )
+            legacy.delete(ids=batch["ids"])
+            moved += len(batch["ids"])
+
+        self.get_client().delete_collection(LEGACY_COLLECTION)
+        return moved
+
+    async def migrate_exchange_references(self, db: AsyncSession, batch_size: int = 500) -> tuple[int, int]:
+        # One-shot rewrite of vectors stored with the full exchange text in their metadata
+        # into message-id references. Each old question/answer text is matched to its
+        # ChatMessage row; vectors whose messages no longer exist are dropped.
+        # Returns (vectors rewritten, vectors dropped).
+        rewritten = dropped = 0
+        for collection in self.get_shards():
+            old = collection.get(where={"type": {"$in": ["question", "answer"]}}, include=["metadatas", "embeddings"])
+            legacy = [i for i, meta in enumerate(old["metadatas"]) if "full_exchange" in meta]
+
+            for start in range(0, len(legacy), batch_size):
+                rows = legacy[start:start + batch_size]
+                new_ids, new_embeddings, new_metadatas, old_ids = [], [], [], []
+                for i in rows:
+                    meta = old["metadatas"][i]
+                    old_ids.append(old["ids"][i])
+                    pair = await self.match_exchange(db, meta["session_id"], meta["full_exchange"])
+                    if not pair:
+                        dropped += 1
+                        continue
+                    question_id, answer_id = pair
+                    new_ids.append(f"msg_{question_id if meta['type'] == 'question' else answer_id}")
+                    new_embeddings.append(list(old["embeddings"][i]))
+                    new_metadatas.append({
+                        "session_id": meta["session_id"],
+                        "question_id": question_id,
+                        "answer_id": answer_id,
+                        "type": meta["type"]
+                    })
+                if new_ids:
+                    collection.upsert(ids=new_ids, embeddings=new_embeddings, metadatas=new_metadatas)
+                    rewritten += len(new_ids)
+                collection.delete(ids=old_ids)
+        return rewritten, dropped
+
+    async def match_exchange(self, db: AsyncSession, session_id: str, full_exchange: str):
+        # "User: <question>\nAI: <answer>" -> (question_id, answer_id) of the matching messages
+        question_key, _, answer_key = full_exchange.partition("\nAI: ")
+        question = question_key[len("User: "):]
+        result = await db.execute(
+            select(models.ChatMessage)
+            .where(models.ChatMessage.session_id == session_id, models.ChatMessage.content.in_([question, answer_key]))
+            .order_by(models.ChatMessage.timestamp, models.ChatMessage.id)
+        )
+        pending_question = None
+        for message in result.scalars().all():
+            if message.sender == "user" and message.content == question:
+                pending_question = message.id
+            elif message.sender == "bot" and message.content == answer_key and pending_question is not None:
+                return pending_question, message.id
+        return None
 
 history_manager = HistoryManager()
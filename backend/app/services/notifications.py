@@ -0,0 +1,157 @@
+import asyncio
+import json
+from datetime import datetime, timedelta
+from fastapi import WebSocket
+from sqlalchemy import select, delete, func
+from app.core.config import settings
+from app.core.database import AsyncSessionLocal
+from app.core.metrics import registry, Counter, Gauge, report_error
+from app import models
+
+ws_messages_sent = registry.register(Counter("ws_messages_sent_total", "Messages sent over WebSockets, by event", ("event",)))
+
+class Connection:
+    # One WebSocket with its own bounded send queue, drained by a dedicated task, so a
+    # slow client only ever delays itself
+    def __init__(self, websocket: WebSocket, session_id: str):
+        self.websocket = websocket
+        self.session_id = session_id
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=settings.WS_SEND_QUEUE_SIZE)
+        self.dropped = 0
+        self.sender = None
+
+    def enqueue(self, message: dict):
+        if self.queue.full():
+            # Newest state wins: drop the oldest pending message rather than block
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(message)
+
+    async def send_loop(self):
+        # Sends queued messages, and a heartbeat whenever the socket has been idle
+        while True:
+            try:
+                message = await asyncio.wait_for(self.queue.get(), timeout=settings.WS_HEARTBEAT_SECONDS)
+            except asyncio.TimeoutError:
+                message = {"event": "ping"}
+            await self.websocket.send_json(message)
+            ws_messages_sent.inc(event=message.get("event", ""))
+
+class ConnectionManager:
+    # Sockets held by this process, any number per session (one per open tab)
+    def __init__(self):
+        self.active_connections: dict[str, set[Connection]] = {}
+
+    async def connect(self, websocket: WebSocket, session_id: str) -> Connection:
+        await websocket.accept()
+        connection = Connection(websocket, session_id)
+        connection.sender = asyncio.create_task(self.run_sender(connection))
+        self.active_connections.setdefault(session_id, set()).add(connection)
+        return connection
+
+    async def run_sender(self, connection: Connection):
+        try:
+            await connection.send_loop()
+        except Exception:
+            # The socket is gone; the receive loop in the endpoint cleans up
+            pass
+
+    def disconnect(self, connection: Connection):
+        connections = self.active_connections.get(connection.session_id)
+        if connections:
+            connections.discard(connection)
+            if not connections:
+                del self.active_connections[connection.session_id]
+        if connection.sender:
+            connection.sender.cancel()
+
+    def deliver(self, message: dict, session_id: str):
+        for connection in self.active_connections.get(session_id, ()):
+            connection.enqueue(message)
+
+    def stats(self) -> dict:
+        return {
+            "sessions": len(self.active_connections),
+            "connections": sum(len(c) for c in self.active_connections.values()),
+            "dropped_messages": sum(conn.dropped for c in self.active_connections.values() for conn in c)
+        }
+
+class InProcessBroker:
+    # Default: publisher and sockets live in the same process
+    def __init__(self, manager: ConnectionManager):
+        self.manager = manager
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def publish(self, message: dict, session_id: str):
+        self.manager.deliver(message, session_id)
+
+class SQLiteBroker:
+    # Cross-process fan-out for several uvicorn workers on one host: messages are appended
+    # to the notifications table and every worker polls for new rows, delivering those for
+    # the sockets it holds.
+    def __init__(self, manager: ConnectionManager):
+        self.manager = manager
+        self.poll_interval = settings.NOTIFY_POLL_SECONDS
+        self.retention = timedelta(seconds=settings.NOTIFY_RETENTION_SECONDS)
+        self.last_id = 0
+        self.task = None
+
+    async def start(self):
+        async with AsyncSessionLocal() as db:
+            # Only messages published from now on
+            self.last_id = await db.scalar(select(func.max(models.Notification.id))) or 0
+        self.task = asyncio.create_task(self.poll_loop())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    async def publish(self, message: dict, session_id: str):
+        async with AsyncSessionLocal() as db:
+            db.add(models.Notification(session_id=session_id, payload=json.dumps(message)))
+            await db.commit()
+
+    async def poll_loop(self):
+        polls = 0
+        while True:
+            try:
+                await self.poll()
+                polls += 1
+                # Every worker trims old rows now and then; any of them may do it
+                if polls % 100 == 0:
+                    await self.prune()
+            except Exception as e:
+                report_error("notifications", f"Error polling notifications: {e}")
+            await asyncio.sleep(self.poll_interval)
+
+    async def poll(self):
+        async with AsyncSessionLocal() as db:
+            rows = (await db.execute(
+                select(models.Notification)
+                .where(models.Notification.id > self.last_id)
+                .order_by(models.Notification.id)
+            )).scalars().all()
+        for row in rows:
+            self.last_id = row.id
+            self.manager.deliver(json.loads(row.payload), row.session_id)
+
+    async def prune(self):
+        async with AsyncSessionLocal() as db:
+            await db.execute(delete(models.Notification).where(models.Notification.created_at < datetime.utcnow() - self.retention))
+            await db.commit()
+
+BROKERS = {
+    "memory": InProcessBroker,
+    "sqlite": SQLiteBroker
+}
+
+connection_manager = ConnectionManager()
+registry.register(Gauge("ws_connections_active", "Open WebSocket connections", collect=lambda: connection_manager.stats()["connections"]))
+broker = BROKERS[settings.NOTIFY_BACKEND](connection_manager)
@@ -0,0 +1,157 @@
+import hashlib
+import re
+import time
+from collections import OrderedDict
+import numpy as np
+from app.core.config import settings
+from app.core.metrics import registry, CounterView
+from app.services.gemini_service import FALLBACK_RESPONSE, NO_KEY_RESPONSE
+
+def normalize_message(message: str) -> str:
+    # "Hi!", "hi" and "  HI  " are the same opening message
+    return re.sub(r"\s+", " ", message).strip().lower().rstrip("!?.,~ ")
+
+def context_fingerprint(context: str) -> str:
+    # A reply is only reused under the same conversation context, e.g. the empty
+    # context of a new session
+    return hashlib.sha1((context or "").encode()).hexdigest()
+
+def unit_vector(embedding) -> np.ndarray:
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+class ResponseCache:
+    # Replies to repeated prompts, keyed on the normalized message plus a context
+    # fingerprint. The exact tier is a dict lookup; the semantic tier compares the
+    # question's MiniLM embedding (already computed for history retrieval) with the
+    # cached questions under the same context, as one matrix product per context.
+    # LRU with a TTL and a size bound.
+    def __init__(self):
+        self.enabled = settings.RESPONSE_CACHE_ENABLED
+        self.max_size = settings.RESPONSE_CACHE_SIZE
+        self.ttl = settings.RESPONSE_CACHE_TTL_SECONDS
+        self.threshold = settings.RESPONSE_CACHE_SIMILARITY
+
+        # (fingerprint, normalized message) -> {"response", "vector", "expires_at"}
+        self.entries: OrderedDict[tuple, dict] = OrderedDict()
+        # fingerprint -> keys of its entries, the candidates of a semantic lookup
+        self.by_context: dict[str, set] = {}
+        # fingerprint -> (keys, matrix of their unit vectors), rebuilt after the context changes
+        self.matrices: dict[str, tuple[list, np.ndarray]] = {}
+
+        # Stats
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, message: str, context: str, embedding=None):
+        if not self.enabled:
+            return None
+        now = time.monotonic()
+        fingerprint = context_fingerprint(context)
+        key = (fingerprint, normalize_message(message))
+
+        entry = self.entries.get(key)
+        if entry and entry["expires_at"] <= now:
+            self.remove(key)
+            self.expirations += 1
+            entry = None
+        if entry:
+            self.exact_hits += 1
+            self.entries.move_to_end(key)
+            return dict(entry["response"])
+
+        if embedding is not None:
+            key = self.find_similar(fingerprint, embedding, now)
+            if key:
+                self.semantic_hits += 1
+                self.entries.move_to_end(key)
+                return dict(self.entries[key]["response"])
+
+        self.misses += 1
+        return None
+
+    def find_similar(self, fingerprint: str, embedding, now: float):
+        expired = [key for key in self.by_context.get(fingerprint, ()) if self.entries[key]["expires_at"] <= now]
+        for key in expired:
+            self.remove(key)
+            self.expirations += 1
+        index = self.context_matrix(fingerprint)
+        if index is None:
+            return None
+        keys, matrix = index
+        # Cosine similarity with every cached question at once, the rows are unit vectors
+        similarities = matrix @ unit_vector(embedding)
+        best = int(similarities.argmax())
+        return keys[best] if similarities[best] >= self.threshold else None
+
+    def context_matrix(self, fingerprint: str):
+        index = self.matrices.get(fingerprint)
+        if index is None and fingerprint in self.by_context:
+            keys = list(self.by_context[fingerprint])
+            index = self.matrices[fingerprint] = (keys, np.stack([self.entries[key]["vector"] for key in keys]))
+        return index
+
+    def put(self, message: str, context: str, response: dict, embedding=None):
+        # Fallback replies and replies cut short by an error are never cached
+        if not self.enabled or not response.get("reply_text") or response.get("truncated"):
+            return
+        # Compared on the reply fields alone, the stream path's result event carries more
+        fields = {k: response[k] for k in ("reply_text", "emotion_description", "emotion_category") if k in response}
+        if fields in (FALLBACK_RESPONSE, NO_KEY_RESPONSE):
+            return
+        fingerprint = context_fingerprint(context)
+        key = (fingerprint, normalize_message(message))
+        if key in self.entries:
+            self.remove(key)
+        entry = {
+            "response": fields,
+            "vector": None,
+            "expires_at": time.monotonic() + self.ttl
+        }
+        if embedding is not None:
+            entry["vector"] = unit_vector(embedding)
+            self.by_context.setdefault(fingerprint, set()).add(key)
+            self.matrices.pop(fingerprint, None)
+        self.entries[key] = entry
+
+        while len(self.entries) > self.max_size:
+            oldest = next(iter(self.entries))
+            self.remove(oldest)
+            self.evictions += 1
+
+    def remove(self, key: tuple):
+        self.entries.pop(key, None)
+        keys = self.by_context.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            self.matrices.pop(key[0], None)
+            if not keys:
+                del self.by_context[key[0]]
+
+    def stats(self) -> dict:
+        lookups = self.exact_hits + self.semantic_hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "size": len(self.entries),
+            "max_size": self.max_size,
+            "ttl_seconds": self.ttl,
+            "similarity_threshold": self.threshold,
+            "exact_hits": self.exact_hits,
+            "semantic_hits": self.semantic_hits,
+            "misses": self.misses,
+            "hit_rate": (self.exact_hits + self.semantic_hits) / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations
+        }
+
+response_cache = ResponseCache()
+
+registry.register(CounterView("response_cache_lookups_total", "Response cache lookups by result", lambda: {
+    "exact_hit": response_cache.exact_hits,
+    "semantic_hit": response_cache.semantic_hits,
+    "miss": response_cache.misses
+}, label="result"))
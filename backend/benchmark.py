@@ -0,0 +1,555 @@
+import sys
+import os
+
+# Add the current directory to sys.path to allow importing app
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import argparse
+import asyncio
+import json
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+from types import SimpleNamespace
+
+# Benchmarks against fakes, so results only depend on this code and the machine.
+#
+#   python benchmark.py load --duration 60 --clients 32 --listeners 64 --llm-latency 0.3
+#   python benchmark.py vectors --sizes 10000,100000,1000000
+#   python benchmark.py render --count 2000 --workers 4
+#
+# `load` starts the app under uvicorn in a child process with Gemini and the image
+# generator replaced by fakes of configurable latency, drives mixed traffic (chat
+# turns, session listing, message history, WebSocket listeners) and reports
+# throughput, latency percentiles and the server's RSS.
+# `vectors` times EmotionManager.get_best_emotion and HistoryManager.retrieve_context
+# against stores filled with that many random vectors.
+# `render` measures placeholder avatars per second, with the previous renderer as baseline.
+# All run against a throwaway DATA_DIR; --json writes the report for later comparison.
+
+CATEGORIES = ["happy", "sad", "angry", "confused", "neutral"]
+MESSAGES = [
+    "hi", "how are you?", "tell me a joke", "I lost my keys again",
+    "what's the weather like on Mars?", "I got the job!", "why is the sky blue?",
+    "this is so frustrating", "can you explain recursion?", "good night"
+]
+EMBEDDING_DIM = 384 # all-MiniLM-L6-v2
+
+def percentile(values: list, p: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * p), len(ordered) - 1)]
+
+def summarize(latencies: list) -> dict:
+    return {
+        "count": len(latencies),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+        "p90_ms": round(percentile(latencies, 0.90) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+        "max_ms": round(max(latencies) * 1000, 2) if latencies else 0.0
+    }
+
+def rss_mb(pid: int):
+    # Resident set size from /proc (Linux), None elsewhere
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        return None
+    return None
+
+# --- Fakes -----------------------------------------------------------------------
+
+class FakeGeminiModel:
+    # Stands in for genai.GenerativeModel: waits `latency` (+/- jitter) and answers in the
+    # JSON shape the real prompt asks for. A share of the replies carries an emotion with
+    # no seeded avatar, so the avatar generation queue sees traffic too.
+    def __init__(self, latency: float, jitter: float, novel_rate: float, seed: int):
+        self.latency = latency
+        self.jitter = jitter
+        self.novel_rate = novel_rate
+        self.rng = random.Random(seed)
+
+    def reply(self, prompt: str) -> str:
+        if "summary" in prompt and "New turns:" in prompt:
+            return json.dumps({"summary": "The user and the bot had a conversation."})
+        message = prompt.rsplit("User message:", 1)[-1].strip()
+        if self.rng.random() < self.novel_rate:
+            category = "wistful"
+            description = f"a wistful look, variant {self.rng.randrange(50)}"
+        else:
+            category = self.rng.choice(CATEGORIES)
+            description = f"a {category} expression"
+        return json.dumps({
+            "reply_text": f"Here is a fairly ordinary reply to: {message}. " * 3,
+            "emotion_description": description,
+            "emotion_category": category
+        })
+
+    async def generate_content_async(self, prompt: str, stream: bool = False, **kwargs):
+        await asyncio.sleep(max(0.0, self.latency + self.rng.uniform(-self.jitter, self.jitter)))
+        text = self.reply(prompt)
+        if not stream:
+            return SimpleNamespace(text=text)
+
+        async def chunks():
+            for i in range(0, len(text), 20):
+                await asyncio.sleep(0.002)
+                yield SimpleNamespace(text=text[i:i + 20])
+        return chunks()
+
+def install_fakes(llm_latency: float, llm_jitter: float, image_latency: float, novel_rate: float, seed: int):
+    # Swaps the model behind the shared GeminiService and the image generator's render step
+    from app.services.gemini_service import gemini_service
+    from app.services.image_generator import image_generator, render_avatar
+
+    gemini_service.model = FakeGeminiModel(llm_latency, llm_jitter, novel_rate, seed)
+    gemini_service.enabled = True
+
+    async def generate_avatar(description: str, executor=None):
+        await asyncio.sleep(image_latency)
+        return await asyncio.to_thread(image_generator.store, render_avatar(description))
+    image_generator.generate_avatar = generate_avatar
+
+def serve(args):
+    # Child process of `load`
+    import uvicorn
+    from app.main import app
+    install_fakes(args.llm_latency, args.llm_jitter, args.image_latency, args.novel_rate, args.seed)
+    uvicorn.run(app, host="127.0.0.1", port=args.port, log_level="warning")
+
+# --- Load test -------------------------------------------------------------------
+
+class LoadStats:
+    def __init__(self):
+        self.latencies: dict[str, list] = {}
+        self.errors: dict[str, int] = {}
+        self.ws_messages = 0
+        self.ws_errors = 0
+        self.rss_samples: list[float] = []
+
+    def record(self, op: str, elapsed: float, ok: bool):
+        if ok:
+            self.latencies.setdefault(op, []).append(elapsed)
+        else:
+            self.errors[op] = self.errors.get(op, 0) + 1
+
+async def chat_client(client, rng: random.Random, base_url: str, session_id: str, deadline: float, stats: LoadStats, mix: dict, stream_share: float):
+    # The session is created by its first chat turn, like the frontend's fallback path
+    ops, weights = zip(*mix.items())
+
+    while time.perf_counter() < deadline:
+        op = rng.choices(ops, weights)[0]
+        if op == "chat" and rng.random() < stream_share:
+            op = "chat_stream"
+        start = time.perf_counter()
+        try:
+            if op == "chat":
+                response = await client.post(f"{base_url}/api/v1/chat", json={"user_message": rng.choice(MESSAGES), "session_id": session_id})
+            elif op == "chat_stream":
+                async with client.stream("POST", f"{base_url}/api/v1/chat/stream", json={"user_message": rng.choice(MESSAGES), "session_id": session_id}) as response:
+                    async for _ in response.aiter_bytes():
+                        pass
+            elif op == "list_sessions":
+                response = await client.get(f"{base_url}/api/v1/sessions", params={"limit": 20})
+            else:
+                response = await client.get(f"{base_url}/api/v1/sessions/{session_id}/messages", params={"limit": 50})
+            stats.record(op, time.perf_counter() - start, response.status_code < 400)
+        except Exception:
+            stats.record(op, time.perf_counter() - start, False)
+
+async def ws_listener(ws_url: str, deadline: float, stats: LoadStats):
+    import websockets
+    try:
+        async with websockets.connect(ws_url) as ws:
+            while True:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    return
+                try:
+                    await asyncio.wait_for(ws.recv(), timeout=remaining)
+                    stats.ws_messages += 1
+                except asyncio.TimeoutError:
+                    return
+    except Exception:
+        stats.ws_errors += 1
+
+async def sample_rss(pid: int, deadline: float, stats: LoadStats):
+    while time.perf_counter() < deadline:
+        value = rss_mb(pid)
+        if value is not None:
+            stats.rss_samples.append(value)
+        await asyncio.sleep(0.5)
+
+async def wait_until_ready(client, base_url: str, process, timeout: float = 120):
+    # Ready once the embedding model has loaded, give it time
+    start = time.perf_counter()
+    while time.perf_counter() - start < timeout:
+        if process.poll() is not None:
+            raise RuntimeError("server exited during startup")
+        try:
+            if (await client.get(f"{base_url}/readyz")).status_code == 200:
+                return
+        except Exception:
+            pass
+        await asyncio.sleep(0.25)
+    raise RuntimeError("server did not become ready")
+
+async def drive(args, process, base_url: str) -> dict:
+    import httpx
+    rng = random.Random(args.seed)
+    stats = LoadStats()
+    mix = {"chat": args.chat_weight, "list_sessions": args.list_weight, "history": args.history_weight}
+
+    limits = httpx.Limits(max_connections=args.clients + 8)
+    async with httpx.AsyncClient(timeout=60, limits=limits) as client:
+        await wait_until_ready(client, base_url, process)
+        idle_rss = rss_mb(process.pid)
+
+        if args.warmup:
+            # Loads the embedding model and fills the first caches outside the measurement
+            session_id = (await client.post(f"{base_url}/api/v1/sessions", json={"title": "New Chat"})).json()["id"]
+            for message in MESSAGES[:args.warmup]:
+                await client.post(f"{base_url}/api/v1/chat", json={"user_message": message, "session_id": session_id})
+
+        start = time.perf_counter()
+        deadline = start + args.duration
+        ws_base = base_url.replace("http://", "ws://")
+        tasks = [
+            chat_client(client, random.Random(rng.random()), base_url, f"bench_{i}", deadline, stats, mix, args.stream_share)
+            for i in range(args.clients)
+        ]
+        # Listeners follow the clients' sessions, so avatar updates reach them
+        tasks += [ws_listener(f"{ws_base}/ws/bench_{i % args.clients}", deadline, stats) for i in range(args.listeners)]
+        tasks.append(sample_rss(process.pid, deadline, stats))
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - start
+
+        metrics = (await client.get(f"{base_url}/metrics")).text
+
+    completed = sum(len(v) for v in stats.latencies.values())
+    return {
+        "duration_s": round(elapsed, 2),
+        "clients": args.clients,
+        "listeners": args.listeners,
+        "llm_latency_s": args.llm_latency,
+        "requests": completed,
+        "throughput_rps": round(completed / elapsed, 2),
+        "operations": {op: summarize(values) for op, values in sorted(stats.latencies.items())},
+        "errors": stats.errors,
+        "ws_messages": stats.ws_messages,
+        "ws_errors": stats.ws_errors,
+        "rss_mb": {
+            "idle": round(idle_rss, 1) if idle_rss else None,
+            "peak": round(max(stats.rss_samples), 1) if stats.rss_samples else None,
+            "final": round(stats.rss_samples[-1], 1) if stats.rss_samples else None
+        },
+        "stage_seconds": stage_means(metrics)
+    }
+
+def stage_means(metrics: str) -> dict:
+    # Mean per chat stage from the server's /metrics histogram
+    sums, counts = {}, {}
+    for line in metrics.splitlines():
+        if line.startswith("chat_stage_seconds_sum") or line.startswith("chat_stage_seconds_count"):
+            name, value = line.rsplit(" ", 1)
+            stage = name.split('stage="', 1)[1].split('"', 1)[0]
+            (sums if "_sum" in name else counts)[stage] = float(value)
+    return {stage: round(sums[stage] / counts[stage] * 1000, 2) for stage in sums if counts.get(stage)}
+
+def load(args):
+    data_dir = tempfile.mkdtemp(prefix="chatbot-bench-")
+    env = dict(os.environ, DATA_DIR=data_dir)
+    command = [
+        sys.executable, os.path.abspath(__file__), "serve",
+        "--port", str(args.port),
+        "--llm-latency", str(args.llm_latency),
+        "--llm-jitter", str(args.llm_jitter),
+        "--image-latency", str(args.image_latency),
+        "--novel-rate", str(args.novel_rate),
+        "--seed", str(args.seed)
+    ]
+    process = subprocess.Popen(command, env=env, cwd=os.path.dirname(os.path.abspath(__file__)))
+    try:
+        report = asyncio.run(drive(args, process, f"http://127.0.0.1:{args.port}"))
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+        shutil.rmtree(data_dir, ignore_errors=True)
+    output(report, args.json)
+
+# --- Vector store microbenchmarks -------------------------------------------------
+
+def random_vectors(rng, count: int):
+    # Unit-length like MiniLM output; numpy ships with chromadb
+    import numpy as np
+    vectors = rng.standard_normal((count, EMBEDDING_DIM)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors
+
+def fill_emotions(emotion_manager, rng, size: int, batch_size: int):
+    for start in range(0, size, batch_size):
+        count = min(batch_size, size - start)
+        emotion_manager.get_collection().add(
+            ids=[f"bench_{start + i}" for i in range(count)],
+            embeddings=random_vectors(rng, count).tolist(),
+            documents=[f"benchmark emotion {start + i}" for i in range(count)],
+            metadatas=[{"image_path": "/static/avatars/neutral_01.png", "source": "benchmark"}] * count
+        )
+
+def fill_history(history_manager, engine, models, rng, size: int, sessions: int, batch_size: int):
+    # size vectors = size / 2 exchanges, each backed by two message rows
+    from datetime import datetime
+    exchanges = size // 2
+    with engine.begin() as connection:
+        connection.execute(models.ChatSession.__table__.insert(), [
+            {"id": f"bench_{s}", "title": "benchmark", "created_at": datetime.utcnow(), "summary_upto_message_id": 0}
+            for s in range(sessions)
+        ])
+    message_id = 0
+    for start in range(0, exchanges, batch_size):
+        count = min(batch_size, exchanges - start)
+        rows, batch = [], []
+        question_vectors = random_vectors(rng, count).tolist()
+        answer_vectors = random_vectors(rng, count).tolist()
+        for i in range(count):
+            session_id = f"bench_{(start + i) % sessions}"
+            question_id, answer_id = message_id + 1, message_id + 2
+            message_id += 2
+            rows += [
+                {"id": question_id, "session_id": session_id, "sender": "user", "content": f"question {start + i}", "timestamp": datetime.utcnow()},
+                {"id": answer_id, "session_id": session_id, "sender": "bot", "content": f"answer {start + i}", "timestamp": datetime.utcnow()}
+            ]
+            batch.append((session_id, question_id, answer_id, question_vectors[i], answer_vectors[i]))
+        with engine.begin() as connection:
+            connection.execute(models.ChatMessage.__table__.insert(), rows)
+        history_manager.store_exchanges(batch)
+
+def time_calls(call, queries: list) -> dict:
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        call(query)
+        latencies.append(time.perf_counter() - start)
+    return summarize(latencies)
+
+def run_vector_size(size: int, args) -> dict:
+    # Runs in its own process with its own DATA_DIR, so every size starts from empty stores
+    import numpy as np
+    from app.core.database import engine, AsyncSessionLocal, init_schema
+    from app.services.emotion_manager import emotion_manager
+    from app.services.history_manager import history_manager
+    from app import models
+
+    init_schema()
+    rng = np.random.default_rng(args.seed)
+
+    start = time.perf_counter()
+    fill_emotions(emotion_manager, rng, size, args.batch_size)
+    emotion_fill = time.perf_counter() - start
+    start = time.perf_counter()
+    fill_history(history_manager, engine, models, rng, size, args.sessions, args.batch_size // 2)
+    history_fill = time.perf_counter() - start
+
+    queries = random_vectors(rng, args.queries).tolist()
+    emotions = time_calls(lambda q: emotion_manager.get_best_emotion("", embedding=q), queries)
+
+    async def history_queries():
+        query_rng = random.Random(args.seed)
+        latencies = []
+        async with AsyncSessionLocal() as db:
+            for query in queries:
+                session_id = f"bench_{query_rng.randrange(args.sessions)}"
+                start = time.perf_counter()
+                await history_manager.retrieve_context(db, session_id, "", query_embedding=query)
+                latencies.append(time.perf_counter() - start)
+        return summarize(latencies)
+
+    return {
+        "vectors": size,
+        "fill_seconds": {"emotions": round(emotion_fill, 1), "history": round(history_fill, 1)},
+        "get_best_emotion": emotions,
+        "retrieve_context": asyncio.run(history_queries()),
+        "rss_mb": round(rss_mb(os.getpid()) or 0, 1)
+    }
+
+def vectors(args):
+    results = []
+    for size in [int(s) for s in args.sizes.split(",")]:
+        data_dir = tempfile.mkdtemp(prefix="chatbot-bench-")
+        try:
+            command = [
+                sys.executable, os.path.abspath(__file__), "vector-size", str(size),
+                "--queries", str(args.queries), "--sessions", str(args.sessions),
+                "--batch-size", str(args.batch_size), "--seed", str(args.seed)
+            ]
+            completed = subprocess.run(command, env=dict(os.environ, DATA_DIR=data_dir), capture_output=True, text=True)
+            if completed.returncode != 0:
+                print(completed.stderr, file=sys.stderr)
+                raise RuntimeError(f"vector benchmark at {size} vectors failed")
+            result = json.loads(completed.stdout.strip().splitlines()[-1])
+            print(f"{size} vectors: get_best_emotion p50={result['get_best_emotion']['p50_ms']}ms, "
+                  f"retrieve_context p50={result['retrieve_context']['p50_ms']}ms", file=sys.stderr)
+            results.append(result)
+        finally:
+            shutil.rmtree(data_dir, ignore_errors=True)
+    output({"vector_benchmarks": results}, args.json)
+
+def vector_size(args):
+    # Child process of `vectors`; the report is the last line on stdout
+    print(json.dumps(run_vector_size(args.size, args)))
+
+# --- Avatar rendering -------------------------------------------------------------
+
+def legacy_render_avatar(description: str) -> dict:
+    # The renderer as it was before fonts, the template and line masks were cached:
+    # font lookup, fresh canvas and text wrapping on every call, optimized PNG, variants
+    # decoded back from the PNG and encoded at WebP method 4
+    import io
+    from PIL import Image, ImageDraw, ImageFont
+    from app.core.config import settings
+
+    img = Image.new('RGB', (200, 200), color=(73, 109, 137))
+    d = ImageDraw.Draw(img)
+    try:
+        font = ImageFont.truetype("arial.ttf", 15)
+    except IOError:
+        font = ImageFont.load_default()
+    words = description.split()
+    lines = []
+    current_line = []
+    for word in words:
+        current_line.append(word)
+        if len(" ".join(current_line)) > 20:
+            lines.append(" ".join(current_line[:-1]))
+            current_line = [word]
+    lines.append(" ".join(current_line))
+    y_text = 50
+    for line in lines[:5]:
+        d.text((10, y_text), line, fill=(255, 255, 255), font=font)
+        y_text += 20
+    d.text((10, 10), "AI Generated:", fill=(255, 255, 0), font=font)
+    buffer = io.BytesIO()
+    img.save(buffer, format="PNG", optimize=True)
+    png = buffer.getvalue()
+
+    img = Image.open(io.BytesIO(png)).convert("RGB")
+    webp = io.BytesIO()
+    img.save(webp, format="WEBP", quality=settings.AVATAR_WEBP_QUALITY, method=4)
+    img.thumbnail((settings.AVATAR_THUMB_SIZE, settings.AVATAR_THUMB_SIZE))
+    thumb = io.BytesIO()
+    img.save(thumb, format="WEBP", quality=settings.AVATAR_WEBP_QUALITY, method=4)
+    return {"png": png, "webp": webp.getvalue(), "thumb": thumb.getvalue()}
+
+def legacy_render_avatars(descriptions: list) -> list:
+    return [legacy_render_avatar(description) for description in descriptions]
+
+def render_descriptions(count: int, seed: int) -> list:
+    # Emotion-like phrases from a small vocabulary, so lines recur the way they do in traffic
+    rng = random.Random(seed)
+    moods = ["wistful", "gleeful", "puzzled", "weary", "smug", "startled", "serene", "grumpy"]
+    features = ["half smile", "raised eyebrow", "tilted head", "wide eyes", "pursed lips", "soft gaze"]
+    return [
+        f"a {rng.choice(moods)} {rng.choice(features)} with {rng.choice(features)}, variant {i}"
+        for i in range(count)
+    ]
+
+def time_renders(render_chunk, descriptions: list, workers: int, chunk_size: int) -> float:
+    # Images per second, in-process when workers is 0, otherwise across a spawn process pool
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    chunks = [descriptions[i:i + chunk_size] for i in range(0, len(descriptions), chunk_size)]
+    if workers == 0:
+        start = time.perf_counter()
+        for chunk in chunks:
+            render_chunk(chunk)
+        return len(descriptions) / (time.perf_counter() - start)
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        # Start the workers and let each import Pillow before timing
+        list(pool.map(render_chunk, [descriptions[:1]] * workers))
+        start = time.perf_counter()
+        for _ in pool.map(render_chunk, chunks):
+            pass
+        return len(descriptions) / (time.perf_counter() - start)
+
+def render(args):
+    from app.services.image_generator import render_avatars
+    descriptions = render_descriptions(args.count, args.seed)
+    report = {"images": args.count, "chunk_size": args.chunk_size, "images_per_second": {}}
+    for workers in sorted({0, args.workers}):
+        label = "single_process" if workers == 0 else f"pool_{workers}_workers"
+        report["images_per_second"][label] = {
+            "before": round(time_renders(legacy_render_avatars, descriptions, workers, args.chunk_size), 1),
+            "after": round(time_renders(render_avatars, descriptions, workers, args.chunk_size), 1)
+        }
+    output(report, args.json)
+
+def output(report: dict, path: str = None):
+    text = json.dumps(report, indent=2)
+    if path:
+        with open(path, "w") as f:
+            f.write(text)
+    print(text)
+
+def main():
+    parser = argparse.ArgumentParser(description="Load tests and vector store benchmarks against fake Gemini and image backends.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    def add_fake_options(command):
+        command.add_argument("--seed", type=int, default=42)
+        command.add_argument("--llm-latency", type=float, default=0.3, help="Seconds per fake Gemini call (default 0.3)")
+        command.add_argument("--llm-jitter", type=float, default=0.1, help="Uniform +/- jitter on the Gemini latency (default 0.1)")
+        command.add_argument("--image-latency", type=float, default=1.0, help="Seconds per fake avatar generation (default 1.0)")
+        command.add_argument("--novel-rate", type=float, default=0.1, help="Share of replies with an emotion that needs a new avatar (default 0.1)")
+        command.add_argument("--port", type=int, default=8765)
+
+    load_command = commands.add_parser("load", help="Mixed-traffic load test against a local server")
+    add_fake_options(load_command)
+    load_command.add_argument("--duration", type=float, default=30, help="Seconds of measured traffic (default 30)")
+    load_command.add_argument("--clients", type=int, default=16, help="Concurrent HTTP clients, one session each (default 16)")
+    load_command.add_argument("--listeners", type=int, default=32, help="Open WebSocket listeners (default 32)")
+    load_command.add_argument("--chat-weight", type=float, default=0.5)
+    load_command.add_argument("--list-weight", type=float, default=0.2)
+    load_command.add_argument("--history-weight", type=float, default=0.3)
+    load_command.add_argument("--stream-share", type=float, default=0.3, help="Share of chat turns sent to /chat/stream (default 0.3)")
+    load_command.add_argument("--warmup", type=int, default=3, help="Chat turns sent before measuring (default 3)")
+    load_command.add_argument("--json", help="Also write the report to this file")
+
+    serve_command = commands.add_parser("serve", help=argparse.SUPPRESS)
+    add_fake_options(serve_command)
+
+    vectors_command = commands.add_parser("vectors", help="get_best_emotion / retrieve_context at several store sizes")
+    vectors_command.add_argument("--seed", type=int, default=42)
+    vectors_command.add_argument("--sizes", default="10000,100000,1000000", help="Comma-separated vector counts (default 10k,100k,1M)")
+    vectors_command.add_argument("--queries", type=int, default=200, help="Timed queries per size (default 200)")
+    vectors_command.add_argument("--sessions", type=int, default=1000, help="Sessions the history vectors are spread over (default 1000)")
+    vectors_command.add_argument("--batch-size", type=int, default=5000, help="Vectors per Chroma add() while filling (default 5000)")
+    vectors_command.add_argument("--json", help="Also write the report to this file")
+
+    render_command = commands.add_parser("render", help="Placeholder avatars per second, before and after the cached renderer")
+    render_command.add_argument("--seed", type=int, default=42)
+    render_command.add_argument("--count", type=int, default=1000, help="Avatars rendered per measurement (default 1000)")
+    render_command.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Process pool size (default: CPU count)")
+    render_command.add_argument("--chunk-size", type=int, default=16, help="Avatars per pool task (default 16)")
+    render_command.add_argument("--json", help="Also write the report to this file")
+
+    size_command = commands.add_parser("vector-size", help=argparse.SUPPRESS)
+    size_command.add_argument("size", type=int)
+    size_command.add_argument("--queries", type=int, default=200)
+    size_command.add_argument("--sessions", type=int, default=1000)
+    size_command.add_argument("--batch-size", type=int, default=5000)
+    size_command.add_argument("--seed", type=int, default=42)
+
+    args = parser.parse_args()
+    {"load": load, "serve": serve, "vectors": vectors, "vector-size": vector_size, "render": render}[args.command](args)
+
+if __name__ == "__main__":
+    main()
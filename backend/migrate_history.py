@@ -0,0 +1,23 @@
+import sys
+import os
+
+# Add the current directory to sys.path to allow importing app
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import asyncio
+from app.services.history_manager import history_manager
+from app.core.database import AsyncSessionLocal
+
+async def migrate_history():
+    print("Migrating chat history into sharded collections...")
+    moved = history_manager.migrate_legacy_collection()
+    print(f"Moved {moved} vectors into {history_manager.shard_count} shards.")
+
+    print("Replacing stored exchange text with message references...")
+    async with AsyncSessionLocal() as db:
+        rewritten, dropped = await history_manager.migrate_exchange_references(db)
+    print(f"Rewrote {rewritten} vectors, dropped {dropped} whose messages no longer exist.")
+    print("Migration complete.")
+
+if __name__ == "__main__":
+    asyncio.run(migrate_history())
@@ -0,0 +1,160 @@
+import sys
+import os
+
+# Add the current directory to sys.path to allow importing app
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import argparse
+import asyncio
+import hashlib
+import json
+import time
+from collections import OrderedDict, deque
+from datetime import datetime
+from types import SimpleNamespace
+from sqlalchemy import select
+from app.core.database import AsyncSessionLocal, init_schema
+from app.services.gemini_service import GeminiService, gemini_service
+from app.services.history_manager import history_manager
+from app.services.embedding_service import embedding_service
+from app.services.context_builder import context_builder
+from app.services.avatar_index import avatar_index
+from app import models
+
+# Replays logged chat turns through the same context, Gemini and storage path as
+# POST /api/v1/chat, without the HTTP round trips.
+#
+#   python replay.py conversations.jsonl --concurrency 16 --offline > results.jsonl
+#
+# Input lines are {"session_id": ..., "user_message": ...} like a chat request. Turns of
+# one session run in order, different sessions run side by side: each round takes the
+# next turn of up to --concurrency sessions, embeds all their questions in one call,
+# commits all their messages in one transaction and writes all their history vectors
+# with one add() per shard. Results are written as one JSON line per turn as each round
+# finishes. Replies are never taken from the response cache, no avatar generation jobs
+# are queued and the rolling session summaries are not updated.
+
+CATEGORIES = ["happy", "sad", "angry", "confused", "neutral"]
+
+class OfflineModel:
+    # Deterministic stand-in for the Gemini model, so a replay runs without a key or network
+    async def generate_content_async(self, prompt: str, **kwargs):
+        message = prompt.rsplit("User message:", 1)[-1].strip()
+        category = CATEGORIES[int(hashlib.sha1(message.encode()).hexdigest(), 16) % len(CATEGORIES)]
+        return SimpleNamespace(text=json.dumps({
+            "reply_text": f"You said: {message}",
+            "emotion_description": f"a {category} expression",
+            "emotion_category": category
+        }))
+
+def read_turns(path: str):
+    source = sys.stdin if path == "-" else open(path, encoding="utf-8")
+    with source:
+        for line_number, line in enumerate(source, 1):
+            line = line.strip()
+            if line:
+                yield line_number, json.loads(line)
+
+async def run_round(turns: list[tuple], service: GeminiService) -> list[dict]:
+    # `turns` holds (line_number, session_id, user_message) for distinct sessions
+    started = time.perf_counter()
+    question_embeddings = await embedding_service.aembed([history_manager.format_question(m) for _, _, m in turns])
+
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(select(models.ChatSession).where(models.ChatSession.id.in_([s for _, s, _ in turns])))
+        sessions = {s.id: s for s in result.scalars().all()}
+    for _, session_id, _ in turns:
+        if session_id not in sessions:
+            sessions[session_id] = models.ChatSession(id=session_id, title="New Chat")
+
+    async def answer(session_id: str, user_message: str, embedding):
+        # Each turn reads its context on its own connection, concurrently with the others
+        async with AsyncSessionLocal() as db:
+            context = await context_builder.build(db, sessions[session_id], embedding)
+        return await service.generate_response(user_message, context)
+
+    responses = await asyncio.gather(*(
+        answer(session_id, user_message, embedding)
+        for (_, session_id, user_message), embedding in zip(turns, question_embeddings)
+    ))
+
+    # Every message of the round in one transaction
+    pairs = []
+    async with AsyncSessionLocal() as db:
+        for (_, session_id, user_message), response in zip(turns, responses):
+            db_session = await db.merge(sessions[session_id])
+            if db_session.title == "New Chat":
+                db_session.title = " ".join(user_message.split()[:5])
+            user_msg = models.ChatMessage(session_id=session_id, sender="user", content=user_message, timestamp=datetime.utcnow())
+            bot_msg = models.ChatMessage(session_id=session_id, sender="bot", content=response.get("reply_text", ""))
+            db.add_all([user_msg, bot_msg])
+            pairs.append((user_msg, bot_msg))
+        await db.commit()
+
+    answer_embeddings = await embedding_service.aembed([history_manager.format_answer(bot.content) for _, bot in pairs])
+    await asyncio.to_thread(history_manager.store_exchanges, [
+        (session_id, user_msg.id, bot_msg.id, question_embedding, answer_embedding)
+        for (_, session_id, _), (user_msg, bot_msg), question_embedding, answer_embedding
+        in zip(turns, pairs, question_embeddings, answer_embeddings)
+    ])
+
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    results = []
+    for (line_number, session_id, user_message), response in zip(turns, responses):
+        category = response.get("emotion_category", "neutral").lower()
+        image_path, _ = await avatar_index.resolve(category, response.get("emotion_description", "neutral"))
+        results.append({
+            "line": line_number,
+            "session_id": session_id,
+            "user_message": user_message,
+            "reply_text": response.get("reply_text", ""),
+            "emotion_category": category,
+            "emotion_description": response.get("emotion_description"),
+            "avatar_url": image_path,
+            "round_ms": round(elapsed_ms, 1)
+        })
+    return results
+
+async def replay(path: str, output, concurrency: int, offline: bool):
+    service = GeminiService(model=OfflineModel()) if offline else gemini_service
+
+    # Turns queued per session, in input order
+    queues: OrderedDict[str, deque] = OrderedDict()
+    for line_number, turn in read_turns(path):
+        queues.setdefault(turn["session_id"], deque()).append((line_number, turn["session_id"], turn["user_message"]))
+
+    total = 0
+    started = time.perf_counter()
+    while queues:
+        turns = [queue.popleft() for queue in list(queues.values())[:concurrency]]
+        for _, session_id, _ in turns:
+            if not queues[session_id]:
+                del queues[session_id]
+        for result in await run_round(turns, service):
+            output.write(json.dumps(result) + "\n")
+        output.flush()
+        total += len(turns)
+
+    elapsed = time.perf_counter() - started
+    print(f"Replayed {total} turns in {elapsed:.1f}s ({total / elapsed if elapsed else 0:.1f} turns/s)", file=sys.stderr)
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay logged chat turns and write the replies as JSONL.")
+    parser.add_argument("input", help="JSONL file of {\"session_id\", \"user_message\"} lines, or - for stdin")
+    parser.add_argument("--output", "-o", help="Write results here instead of stdout")
+    parser.add_argument("--concurrency", "-c", type=int, default=16, help="Sessions replayed side by side (default 16)")
+    parser.add_argument("--offline", action="store_true", help="Answer with a deterministic stub instead of calling Gemini")
+    args = parser.parse_args()
+
+    init_schema()
+    avatar_index.load()
+
+    output = open(args.output, "w", encoding="utf-8") if args.output else sys.stdout
+    try:
+        asyncio.run(replay(args.input, output, max(args.concurrency, 1), args.offline))
+    finally:
+        if args.output:
+            output.close()
+
+if __name__ == "__main__":
+    main()
@@ -6,7 +6,7 @@ from app.core.config import settings
 def reset_database():
     print("Resetting database collection...")
     try:
-        client = chromadb.PersistentClient(path=os.path.join(settings.BASE_DIR, "chroma_db"))
+        client = chromadb.PersistentClient(path=os.path.join(settings.DATA_DIR, "chroma_db"))
         try:
             client.delete_collection("avatar_emotions")
             print("Collection 'avatar_emotions' deleted.")
@@ -21,7 +21,8 @@ def seed_emotions():
         emotion_manager.add_emotion(
             emotion_id=emotion["id"],
             description=emotion["description"],
-            image_path=emotion["image_path"]
+            image_path=emotion["image_path"],
+            category=emotion["id"].split("_")[0]
         )
     print("Seeding complete.")
 
@@ -0,0 +1,9 @@
+import os
+import sys
+import tempfile
+
+# Tests import the app like the scripts next to seed.py do, and keep the SQLite
+# database and Chroma stores in a throwaway directory
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DATA_DIR", tempfile.mkdtemp(prefix="chatbot-tests-"))
+os.environ["GEMINI_API_KEY"] = ""
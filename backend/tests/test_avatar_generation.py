@@ -0,0 +1,255 @@
+import asyncio
+import json
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timedelta
+import pytest
+
+pytest.importorskip("chromadb")
+
+from sqlalchemy import delete
+from app import models
+from app.core.database import AsyncSessionLocal, init_schema
+from app.services.avatar_generation import AvatarGeneration
+
+@pytest.fixture
+def generation():
+    init_schema()
+
+    async def clear():
+        async with AsyncSessionLocal() as db:
+            await db.execute(delete(models.AvatarJob))
+            await db.commit()
+
+    asyncio.run(clear())
+    return AvatarGeneration()
+
+async def add_job(**fields):
+    fields.setdefault("description", "a wistful half smile")
+    fields.setdefault("session_ids", json.dumps(["s1"]))
+    async with AsyncSessionLocal() as db:
+        job = models.AvatarJob(**fields)
+        db.add(job)
+        await db.commit()
+        return job.id
+
+async def get_job(job_id):
+    async with AsyncSessionLocal() as db:
+        return await db.get(models.AvatarJob, job_id)
+
+def test_running_job_with_live_lease_is_not_claimed(generation):
+    async def run():
+        await add_job(status="running", claimed_by="other-process", lease_until=datetime.utcnow() + timedelta(minutes=5))
+        return await generation.claim()
+
+    assert asyncio.run(run()) is None
+
+def test_running_job_with_expired_lease_is_claimed_again(generation):
+    async def run():
+        job_id = await add_job(status="running", attempts=1, claimed_by="other-process", lease_until=datetime.utcnow() - timedelta(seconds=1))
+        claimed = await generation.claim()
+        return job_id, claimed
+
+    job_id, claimed = asyncio.run(run())
+    assert claimed.id == job_id
+    assert claimed.claimed_by == generation.owner
+    assert claimed.lease_until > datetime.utcnow()
+    assert claimed.attempts == 2
+
+def test_lease_is_renewed_while_the_job_runs(generation):
+    generation.lease = 0.3
+
+    async def run():
+        job_id = await add_job()
+        job = await generation.claim()
+        first_lease = job.lease_until
+        renew = asyncio.create_task(generation.renew_lease(job_id))
+        await asyncio.sleep(0.25)
+        renew.cancel()
+        return first_lease, (await get_job(job_id)).lease_until
+
+    first_lease, renewed_lease = asyncio.run(run())
+    assert renewed_lease > first_lease
+
+@pytest.fixture
+def fake_render(monkeypatch, generation):
+    # Jobs "render" instantly, notifications are recorded
+    from app.services import avatar_generation as module
+    notified = []
+
+    async def generate_avatar(description, executor=None):
+        return "/static/avatars/generated_0123456789abcdef0123456789abcdef.png"
+
+    async def notify(session_id, image_url):
+        notified.append(session_id)
+
+    monkeypatch.setattr(module.image_generator, "generate_avatar", generate_avatar)
+    monkeypatch.setattr(module.emotion_manager, "add_emotion", lambda **kwargs: None)
+    generation.notify = notify
+    return notified
+
+def test_join_adds_each_session_once(generation):
+    async def run():
+        job_id = await add_job(status="queued")
+        async with AsyncSessionLocal() as db:
+            await generation.join(db, job_id, "s2")
+            job = await generation.join(db, job_id, "s2")
+        return job
+
+    job = asyncio.run(run())
+    assert json.loads(job.session_ids) == ["s1", "s2"]
+
+def test_session_joining_before_completion_is_notified(generation, fake_render):
+    async def run():
+        job_id = await add_job(status="queued")
+        async with AsyncSessionLocal() as db:
+            await generation.join(db, job_id, "late")
+        await generation.run(await generation.claim())
+
+    asyncio.run(run())
+    assert fake_render == ["s1", "late"]
+
+def test_session_joining_after_completion_is_notified(generation, fake_render):
+    embedding = [0.0, 1.0]
+
+    async def run():
+        job_id = await add_job(status="queued")
+        generation.active[job_id] = {"key": "a wistful half smile", "embedding": embedding}
+        job = await generation.claim()
+        # submit() found the job in `active` just before run() finished it
+        find_active = generation.find_active
+        generation.find_active = lambda key, embedding: job_id
+        await generation.run(job)
+        result = await generation.submit("late", "a wistful half smile", embedding)
+        generation.find_active = find_active
+        async with AsyncSessionLocal() as db:
+            return result, await db.get(models.AvatarJob, job_id)
+
+    result, job = asyncio.run(run())
+    assert result["position"] == 0
+    assert fake_render == ["s1", "late"]
+    assert job.status == "done"
+
+class BrokenExecutor:
+    def submit(self, *args, **kwargs):
+        raise BrokenProcessPool("A child process terminated abruptly")
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        self.shut_down = True
+
+def test_broken_pool_propagates_from_generate_avatar():
+    from app.services.image_generator import image_generator
+    with pytest.raises(BrokenProcessPool):
+        asyncio.run(image_generator.generate_avatar("a wistful half smile", executor=BrokenExecutor()))
+
+def test_broken_pool_is_replaced_and_job_requeued(generation, fake_render, monkeypatch):
+    from app.services import avatar_generation as module
+    broken = BrokenExecutor()
+    generation.pool = broken
+    replacement = object()
+    monkeypatch.setattr(generation, "make_pool", lambda: replacement)
+    generate_avatar = module.image_generator.generate_avatar
+
+    async def generate_once_broken(description, executor=None):
+        if executor is broken:
+            raise BrokenProcessPool("A child process terminated abruptly")
+        return await generate_avatar(description, executor)
+
+    monkeypatch.setattr(module.image_generator, "generate_avatar", generate_once_broken)
+
+    async def run():
+        job_id = await add_job(status="queued")
+        await generation.run(await generation.claim())
+        requeued = await get_job(job_id)
+        await generation.run(await generation.claim())
+        return requeued, await get_job(job_id)
+
+    requeued, done = asyncio.run(run())
+    assert broken.shut_down
+    assert generation.pool is replacement
+    assert (requeued.status, requeued.attempts, requeued.claimed_by) == ("queued", 0, None)
+    assert (done.status, done.attempts) == ("done", 1)
+    assert generation.failures == 0
+    assert fake_render == ["s1"]
+
+def test_worker_survives_a_failing_claim(generation, fake_render, monkeypatch):
+    from app.services import avatar_generation as module
+    monkeypatch.setattr(module, "WORKER_ERROR_BACKOFF_SECONDS", 0)
+    claim = generation.claim
+    calls = []
+
+    async def claim_failing_once():
+        calls.append(1)
+        if len(calls) == 1:
+            raise RuntimeError("database is locked")
+        return await claim()
+
+    monkeypatch.setattr(generation, "claim", claim_failing_once)
+
+    async def run():
+        job_id = await add_job(status="queued")
+        worker = asyncio.create_task(generation.worker())
+        for _ in range(100):
+            job = await get_job(job_id)
+            if job.status == "done":
+                break
+            await asyncio.sleep(0.05)
+        worker.cancel()
+        await asyncio.gather(worker, return_exceptions=True)
+        return job
+
+    assert asyncio.run(run()).status == "done"
+    assert len(calls) >= 2
+    assert fake_render == ["s1"]
+
+def test_jobs_finished_elsewhere_are_pruned_from_active(generation):
+    embedding = [0.0, 1.0]
+
+    async def run():
+        done = await add_job(status="done", image_url="static/avatars/generated_x.png")
+        failed = await add_job(status="failed")
+        queued = await add_job(status="queued")
+        for job_id in (done, failed, queued):
+            generation.active[job_id] = {"key": f"job {job_id}", "embedding": embedding}
+        await generation.prune_active()
+        return queued
+
+    queued = asyncio.run(run())
+    assert list(generation.active) == [queued]
+
+def test_submit_drops_a_failed_job_it_tried_to_join(generation):
+    embedding = [0.0, 1.0]
+
+    async def run():
+        failed = await add_job(status="failed")
+        generation.active[failed] = {"key": "a wistful half smile", "embedding": embedding}
+        result = await generation.submit("s2", "a wistful half smile", embedding)
+        return failed, result
+
+    failed, result = asyncio.run(run())
+    assert result["job_id"] != failed
+    assert failed not in generation.active
+    assert result["job_id"] in generation.active
+
+def test_resumed_job_is_embedded_when_it_runs_not_at_startup(generation, fake_render, monkeypatch):
+    from app.services import avatar_generation as module
+    embedded = []
+
+    async def aembed(texts):
+        embedded.append(list(texts))
+        return [[0.0, 1.0] for _ in texts]
+
+    monkeypatch.setattr(module.embedding_service, "aembed", aembed)
+    monkeypatch.setattr(generation, "make_pool", lambda: None)
+    generation.worker_count = 0
+
+    async def run():
+        await add_job(status="queued")
+        await generation.start(generation.notify)
+        at_startup = list(embedded)
+        await generation.run(await generation.claim())
+        await generation.stop()
+        return at_startup
+
+    assert asyncio.run(run()) == []
+    assert embedded == [["a wistful half smile"]]
+    assert fake_render == ["s1"]
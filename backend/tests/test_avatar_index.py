@@ -0,0 +1,77 @@
+import asyncio
+import pytest
+
+pytest.importorskip("chromadb")
+
+from app.services import avatar_index as avatar_index_module
+from app.services.avatar_index import AvatarIndex, BASE_CATEGORY_AVATARS
+
+WISTFUL = {
+    "id": "generated_abc_123",
+    "description": "a wistful half smile",
+    "metadata": {"image_path": "/static/avatars/generated_abc.png", "source": "ai-generated", "category": "wistful"}
+}
+
+@pytest.fixture
+def index(monkeypatch):
+    # Stored avatars are the seeded ones plus one generated "wistful" avatar
+    distances = {"a wistful half smile": 0.0, "a slightly wistful half smile": 0.3}
+
+    def get_candidates(description, n_results=5, embedding=None):
+        return [dict(WISTFUL, metadata=dict(WISTFUL["metadata"]), distance=distances.get(description, 1.9))]
+
+    async def aembed(texts):
+        return [[0.0] for _ in texts]
+
+    monkeypatch.setattr(avatar_index_module.emotion_manager, "get_candidates", get_candidates)
+    monkeypatch.setattr(avatar_index_module.embedding_service, "aembed", aembed)
+    index = AvatarIndex()
+    index.loaded = True
+    return index
+
+def test_seeded_categories_resolve_without_a_search(index):
+    image_path, embedding = asyncio.run(index.resolve("happy", "anything at all"))
+    assert image_path == BASE_CATEGORY_AVATARS["happy"]
+    assert embedding is None
+    assert index.decisions["category"] == 1
+
+def test_generated_avatar_does_not_stand_in_for_its_category(index):
+    index.add("a wistful half smile", WISTFUL["metadata"]["image_path"])
+    # A different description in the same category still has to be close enough
+    image_path, embedding = asyncio.run(index.resolve("wistful", "a totally different furious red face"))
+    assert image_path is None
+    assert embedding is not None
+    assert index.decisions == {"category": 0, "cached": 0, "reuse": 0, "generate": 1}
+
+def test_generated_avatar_is_reused_for_close_descriptions(index):
+    index.add("a wistful half smile", WISTFUL["metadata"]["image_path"])
+    assert asyncio.run(index.resolve("wistful", "a wistful half smile!"))[0] == WISTFUL["metadata"]["image_path"]
+    assert asyncio.run(index.resolve("wistful", "a slightly wistful half smile"))[0] == WISTFUL["metadata"]["image_path"]
+    assert index.decisions["cached"] == 1
+    assert index.decisions["reuse"] == 1
+
+def test_searched_decisions_are_kept_for_tuning(index, capsys):
+    asyncio.run(index.resolve("wistful", "a slightly wistful half smile"))
+    asyncio.run(index.resolve("wistful", "a totally different furious red face"))
+    recent = index.stats()["recent"]
+    assert [(r["decision"], r["category"], r["distance"]) for r in recent] == [("reuse", "wistful", 0.3), ("generate", "wistful", 1.9)]
+    assert recent[0]["threshold"] == index.threshold
+    # Nothing is written to stdout per lookup unless AVATAR_LOG_DECISIONS is set
+    assert capsys.readouterr().out == ""
+
+def test_decisions_are_logged_when_enabled(index, capsys, monkeypatch):
+    monkeypatch.setattr(avatar_index_module.settings, "AVATAR_LOG_DECISIONS", True)
+    asyncio.run(index.resolve("wistful", "a slightly wistful half smile"))
+    out = capsys.readouterr().out
+    assert out.startswith("[event] avatar_index: reuse 'a slightly wistful half smile'")
+    assert "distance=0.300" in out
+
+def test_unconfigured_categories_share_one_metrics_label(index):
+    asyncio.run(index.resolve("wistful", "a slightly wistful half smile"))
+    labels = [labels for _, labels, _ in avatar_index_module.match_scores.samples()]
+    assert any('category="other"' in label for label in labels)
+    assert not any('category="wistful"' in label for label in labels)
+    index.category_thresholds = {"wistful": 0.5}
+    assert index.category_label("Wistful") == "wistful"
+    assert index.category_label("happy") == "happy"
+    assert index.category_label(None) == "none"
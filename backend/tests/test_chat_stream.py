@@ -0,0 +1,67 @@
+import json
+import pytest
+
+pytest.importorskip("chromadb")
+pytest.importorskip("google.generativeai")
+
+from types import SimpleNamespace
+from fastapi.testclient import TestClient
+from app import main
+from app.core.database import init_schema
+from app.services.gemini_service import GeminiService
+from app.services.response_cache import ResponseCache
+
+REPLY = {"reply_text": "hello there", "emotion_description": "a calm face", "emotion_category": "neutral"}
+
+class Vector(list):
+    def tolist(self):
+        return list(self)
+
+class FakeEmbeddingModel:
+    def encode(self, texts, convert_to_numpy=True):
+        return [Vector([1.0, float(len(text))]) for text in texts]
+
+class FakeModel:
+    def __init__(self, fail=False):
+        self.fail = fail
+
+    async def generate_content_async(self, prompt, stream=False, **kwargs):
+        if self.fail:
+            raise ValueError("bad request")
+        text = json.dumps(REPLY)
+
+        async def chunks():
+            for i in range(0, len(text), 5):
+                yield SimpleNamespace(text=text[i:i + 5])
+
+        return chunks()
+
+@pytest.fixture
+def cache(monkeypatch):
+    cache = ResponseCache()
+    cache.enabled = True
+    monkeypatch.setattr(main, "response_cache", cache)
+    return cache
+
+@pytest.fixture
+def client(monkeypatch, cache):
+    init_schema()
+    monkeypatch.setattr(main.embedding_service, "model", FakeEmbeddingModel())
+    return TestClient(main.app)
+
+def stream_chat(client, message: str, session_id: str) -> list[dict]:
+    response = client.post("/api/v1/chat/stream", json={"user_message": message, "session_id": session_id})
+    assert response.status_code == 200
+    return [json.loads(line[len("data: "):]) for line in response.text.splitlines() if line.startswith("data: ")]
+
+def test_stream_fallback_reply_is_not_cached(client, cache, monkeypatch):
+    monkeypatch.setattr(main, "gemini_service", GeminiService(model=FakeModel(fail=True)))
+    events = stream_chat(client, "are you there?", "stream_fallback")
+    assert events[-1]["reply_text"] == "I'm having trouble thinking right now."
+    assert len(cache.entries) == 0
+
+def test_stream_reply_is_cached_without_transport_fields(client, cache, monkeypatch):
+    monkeypatch.setattr(main, "gemini_service", GeminiService(model=FakeModel()))
+    events = stream_chat(client, "hello?", "stream_cached")
+    assert events[-1]["reply_text"] == REPLY["reply_text"]
+    assert [entry["response"] for entry in cache.entries.values()] == [REPLY]
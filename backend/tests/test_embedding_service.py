@@ -0,0 +1,95 @@
+import asyncio
+import pytest
+
+pytest.importorskip("chromadb")
+
+from app.services.embedding_service import EmbeddingService
+
+class Vector(list):
+    def tolist(self):
+        return list(self)
+
+class FakeModel:
+    def __init__(self):
+        self.calls = []
+
+    def encode(self, texts, convert_to_numpy=True):
+        self.calls.append(list(texts))
+        return [Vector([float(len(text)), float(sum(map(ord, text)))]) for text in texts]
+
+def make_service(window_ms=10):
+    service = EmbeddingService()
+    service.model = FakeModel()
+    service.batch_window = window_ms / 1000
+    return service
+
+def test_concurrent_aembed_calls_share_one_model_call():
+    service = make_service()
+
+    async def run():
+        return await asyncio.gather(*(service.aembed([f"text {i}"]) for i in range(10)))
+
+    results = asyncio.run(run())
+    assert len(service.model.calls) == 1
+    assert sorted(service.model.calls[0]) == sorted(f"text {i}" for i in range(10))
+    assert results == [service.model.encode([f"text {i}"]) for i in range(10)]
+
+def test_batch_window_does_not_block_the_event_loop():
+    service = make_service(window_ms=50)
+    ticks = []
+
+    async def ticker():
+        while True:
+            ticks.append(None)
+            await asyncio.sleep(0.005)
+
+    async def run():
+        task = asyncio.create_task(ticker())
+        await service.aembed(["slow"])
+        ticks_during_window = len(ticks)
+        task.cancel()
+        return ticks_during_window
+
+    # Other coroutines keep running while the leader waits for the batch to fill
+    assert asyncio.run(run()) >= 3
+    assert len(service.model.calls) == 1
+
+def test_repeated_texts_come_from_the_cache():
+    service = make_service(window_ms=0)
+    first = asyncio.run(service.aembed(["same", "same"]))
+    second = service.embed(["same"])
+    assert first[0] == first[1] == second[0]
+    assert service.model.calls == [["same"]]
+    assert service.cache_hits == 1
+
+def test_cancelled_leader_does_not_strand_the_batch():
+    service = make_service(window_ms=50)
+
+    async def run():
+        leader = asyncio.create_task(service.aembed(["first"]))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        # Later callers are still served, and the cancelled caller's text was encoded
+        return await asyncio.wait_for(service.aembed(["second"]), timeout=1)
+
+    assert asyncio.run(run()) == FakeModel().encode(["second"])
+    assert "first" in service.cache
+    assert service.leader_active is False
+
+def test_cancelled_waiter_does_not_break_the_batch():
+    service = make_service(window_ms=50)
+
+    async def run():
+        leader = asyncio.create_task(service.aembed(["shared"]))
+        await asyncio.sleep(0)
+        cancelled = asyncio.create_task(service.aembed(["shared"]))
+        other = asyncio.create_task(service.aembed(["shared", "own"]))
+        await asyncio.sleep(0.01)
+        cancelled.cancel()
+        return await asyncio.wait_for(asyncio.gather(leader, other), timeout=1), cancelled
+
+    (leader_result, other_result), cancelled = asyncio.run(run())
+    assert cancelled.cancelled()
+    assert leader_result == FakeModel().encode(["shared"])
+    assert other_result == FakeModel().encode(["shared", "own"])
+    assert len(service.model.calls) == 1
@@ -0,0 +1,97 @@
+import asyncio
+import json
+from types import SimpleNamespace
+import pytest
+
+pytest.importorskip("google.generativeai")
+
+from app.core.config import settings
+from app.services.gemini_service import GeminiService, FALLBACK_RESPONSE
+
+REPLY = {"reply_text": "hello there", "emotion_description": "a smile", "emotion_category": "happy"}
+
+class ApiError(Exception):
+    def __init__(self, code):
+        super().__init__(f"status {code}")
+        self.code = code
+
+class FakeModel:
+    # Fails with the given status codes first, then answers; records concurrency
+    def __init__(self, failures=(), delay=0.0, chunks=None):
+        self.failures = list(failures)
+        self.delay = delay
+        self.chunks = chunks
+        self.calls = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def generate_content_async(self, prompt, stream=False, **kwargs):
+        self.calls += 1
+        if self.failures:
+            raise ApiError(self.failures.pop(0))
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.delay)
+        finally:
+            self.in_flight -= 1
+        if stream:
+            return self.stream()
+        return SimpleNamespace(text=json.dumps(REPLY))
+
+    async def stream(self):
+        for chunk in self.chunks:
+            yield SimpleNamespace(text=chunk)
+
+@pytest.fixture(autouse=True)
+def fast_retries(monkeypatch):
+    monkeypatch.setattr(settings, "GEMINI_RETRY_BACKOFF_SECONDS", 0.001)
+    monkeypatch.setattr(settings, "GEMINI_MAX_RETRIES", 3)
+
+def test_transient_errors_are_retried():
+    model = FakeModel(failures=[503, 429])
+    result = asyncio.run(GeminiService(model=model).generate_response("hi"))
+    assert result == REPLY
+    assert model.calls == 3
+
+def test_retries_stop_after_max_retries():
+    model = FakeModel(failures=[503] * 10)
+    result = asyncio.run(GeminiService(model=model).generate_response("hi"))
+    assert result == FALLBACK_RESPONSE
+    assert model.calls == settings.GEMINI_MAX_RETRIES + 1
+
+def test_other_errors_are_not_retried():
+    model = FakeModel(failures=[400])
+    result = asyncio.run(GeminiService(model=model).generate_response("hi"))
+    assert result == FALLBACK_RESPONSE
+    assert model.calls == 1
+
+def test_concurrent_calls_are_limited(monkeypatch):
+    monkeypatch.setattr(settings, "GEMINI_MAX_CONCURRENCY", 2)
+    model = FakeModel(delay=0.01)
+
+    async def run():
+        service = GeminiService(model=model)
+        return await asyncio.gather(*(service.generate_response(f"hi {i}") for i in range(8)))
+
+    assert asyncio.run(run()) == [REPLY] * 8
+    assert model.max_in_flight == 2
+
+def test_stream_releases_slot_before_client_reads_everything(monkeypatch):
+    monkeypatch.setattr(settings, "GEMINI_MAX_CONCURRENCY", 1)
+    text = json.dumps(REPLY)
+    model = FakeModel(chunks=[text[i:i + 4] for i in range(0, len(text), 4)])
+
+    async def run():
+        service = GeminiService(model=model)
+        events = service.stream_response("hi")
+        first = await events.__anext__()
+        # The client stalls after the first token; the slot must still become free
+        await asyncio.wait_for(service.semaphore.acquire(), timeout=1)
+        service.semaphore.release()
+        rest = [event async for event in events]
+        return [first] + rest
+
+    events = asyncio.run(run())
+    assert "".join(e["text"] for e in events if e["type"] == "token") == REPLY["reply_text"]
+    assert events[-1] == {"type": "result", **REPLY}
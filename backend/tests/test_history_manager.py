@@ -0,0 +1,19 @@
+import pytest
+
+pytest.importorskip("chromadb")
+
+from app.core.config import settings
+from app.services.history_manager import HistoryManager
+
+def make_manager(shard_count):
+    manager = HistoryManager()
+    manager.shard_count = shard_count
+    return manager
+
+def test_shard_count_is_recorded_and_checked(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "DATA_DIR", str(tmp_path))
+    assert len(make_manager(4).get_shards()) == 4
+    assert len(make_manager(4).get_shards()) == 4
+
+    with pytest.raises(RuntimeError, match="HISTORY_SHARDS"):
+        make_manager(8).get_shards()
@@ -0,0 +1,7 @@
+from app.core.metrics import Counter, Registry
+
+def test_label_values_are_escaped():
+    registry = Registry()
+    counter = registry.register(Counter("things_total", "Things", ("kind",)))
+    counter.inc(kind='say "hi"\\\nbye')
+    assert 'things_total{kind="say \\"hi\\"\\\\\\nbye"} 1' in registry.render()
@@ -0,0 +1,63 @@
+import asyncio
+import pytest
+from sqlalchemy import delete, text
+from app import models
+from app.core.database import AsyncSessionLocal, engine, init_schema
+from app.services.notifications import SQLiteBroker
+
+class RecordingManager:
+    def __init__(self):
+        self.delivered = []
+
+    def deliver(self, message: dict, session_id: str):
+        self.delivered.append((session_id, message["n"]))
+
+@pytest.fixture
+def broker():
+    init_schema()
+
+    async def clear():
+        async with AsyncSessionLocal() as db:
+            await db.execute(delete(models.Notification))
+            await db.commit()
+
+    asyncio.run(clear())
+    return SQLiteBroker(RecordingManager())
+
+def test_messages_are_delivered_after_pruning_everything(broker):
+    async def run():
+        await broker.start()
+        broker.task.cancel()
+        for n in range(3):
+            await broker.publish({"n": n}, "s1")
+        await broker.poll()
+        # Everything is older than a zero retention
+        broker.retention = broker.retention * 0
+        await broker.prune()
+        async with AsyncSessionLocal() as db:
+            assert await db.scalar(text("SELECT count(*) FROM notifications")) == 0
+        await broker.publish({"n": 3}, "s1")
+        await broker.poll()
+
+    asyncio.run(run())
+    assert broker.manager.delivered == [("s1", 0), ("s1", 1), ("s1", 2), ("s1", 3)]
+
+def test_existing_table_is_rebuilt_with_autoincrement():
+    init_schema()
+    with engine.begin() as conn:
+        conn.execute(text("DROP TABLE notifications"))
+        conn.execute(text(
+            "CREATE TABLE notifications (id INTEGER NOT NULL, session_id VARCHAR, payload TEXT, "
+            "created_at DATETIME, PRIMARY KEY (id))"
+        ))
+        conn.execute(text("CREATE INDEX ix_notifications_created_at ON notifications (created_at)"))
+        conn.execute(text("INSERT INTO notifications (id, session_id, payload) VALUES (7, 's1', :payload)"), {"payload": '{"n": 7}'})
+
+    init_schema()
+    with engine.begin() as conn:
+        sql = conn.execute(text("SELECT sql FROM sqlite_master WHERE name = 'notifications'")).scalar()
+        rows = conn.execute(text("SELECT id, session_id FROM notifications")).all()
+        indexes = conn.execute(text("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'notifications'")).scalars().all()
+    assert "AUTOINCREMENT" in sql
+    assert rows == [(7, "s1")]
+    assert "ix_notifications_created_at" in indexes
@@ -0,0 +1,37 @@
+import pytest
+
+pytest.importorskip("google.generativeai")
+
+from app.services.response_cache import ResponseCache, context_fingerprint
+
+REPLY = {"reply_text": "Hello again.", "emotion_description": "a calm nod", "emotion_category": "neutral"}
+
+def make_cache():
+    cache = ResponseCache()
+    cache.enabled = True
+    return cache
+
+def test_similar_question_under_the_same_context_is_a_semantic_hit():
+    cache = make_cache()
+    cache.put("hello there", "", REPLY, [1.0, 0.0, 0.1])
+    cache.put("goodbye", "", dict(REPLY, reply_text="Farewell."), [0.0, 1.0, 0.0])
+
+    assert cache.get("hello there friend", "", [0.9, 0.05, 0.1]) == REPLY
+    assert cache.get("something else", "", [0.5, 0.5, -1.0]) is None
+    assert cache.get("hello there friend", "another context", [0.9, 0.05, 0.1]) is None
+    assert cache.semantic_hits == 1
+
+def test_removed_and_expired_entries_do_not_match():
+    cache = make_cache()
+    cache.put("hello there", "", REPLY, [1.0, 0.0, 0.0])
+    cache.put("goodbye", "", dict(REPLY, reply_text="Farewell."), [0.0, 1.0, 0.0])
+    assert cache.get("bye now", "", [0.0, 1.0, 0.0])["reply_text"] == "Farewell."
+
+    cache.remove((context_fingerprint(""), "goodbye"))
+    assert cache.get("bye now", "", [0.0, 1.0, 0.0]) is None
+
+    cache.ttl = -1
+    cache.put("hello there", "", REPLY, [1.0, 0.0, 0.0])
+    assert cache.get("hi there", "", [1.0, 0.0, 0.0]) is None
+    assert cache.expirations == 1
+    assert cache.by_context == {}
@@ -1,10 +1,12 @@
 import React, { useState, useEffect } from 'react';
 import ChatInterface from './components/ChatInterface';
 import Sidebar from './components/Sidebar';
+import fetchPage from './fetchPage';
 import './App.css';
 
 function App() {
   const [sessions, setSessions] = useState([]);
+  const [sessionsCursor, setSessionsCursor] = useState(null);
   const [currentSessionId, setCurrentSessionId] = useState(null);
 
   // Fetch sessions on mount
@@ -14,23 +16,33 @@ function App() {
 
   const fetchSessions = async () => {
     try {
-      const response = await fetch('http://localhost:8000/api/v1/sessions');
-      if (response.ok) {
-        const data = await response.json();
-        setSessions(data);
-        // If no session selected and sessions exist, select the first one
-        if (!currentSessionId && data.length > 0) {
-          setCurrentSessionId(data[0].id);
-        } else if (data.length === 0) {
-          // If no sessions, create one
-          createNewSession();
-        }
+      // Newest page only, older sessions are loaded from the sidebar on demand
+      const { items: data, nextCursor } = await fetchPage('http://localhost:8000/api/v1/sessions');
+      setSessions(data);
+      setSessionsCursor(nextCursor);
+      // If no session selected and sessions exist, select the first one
+      if (!currentSessionId && data.length > 0) {
+        setCurrentSessionId(data[0].id);
+      } else if (data.length === 0) {
+        // If no sessions, create one
+        createNewSession();
       }
     } catch (error) {
       console.error("Error fetching sessions:", error);
     }
   };
 
+  const loadMoreSessions = async () => {
+    if (!sessionsCursor) return;
+    try {
+      const { items, nextCursor } = await fetchPage('http://localhost:8000/api/v1/sessions', sessionsCursor);
+      setSessions(prev => prev.concat(items));
+      setSessionsCursor(nextCursor);
+    } catch (error) {
+      console.error("Error fetching sessions:", error);
+    }
+  };
+
   const createNewSession = async () => {
     try {
       const response = await fetch('http://localhost:8000/api/v1/sessions', {
@@ -76,6 +88,8 @@ function App() {
         onSelectSession={setCurrentSessionId}
         onNewSession={createNewSession}
         onDeleteSession={deleteSession}
+        hasMoreSessions={Boolean(sessionsCursor)}
+        onLoadMoreSessions={loadMoreSessions}
       />
       <div style={{ flex: 1, display: 'flex', flexDirection: 'column' }}>
         <h1 style={{ textAlign: 'center', padding: '10px', margin: 0, borderBottom: '1px solid #eee' }}>Raiden Ei</h1>
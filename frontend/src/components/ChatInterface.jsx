@@ -2,13 +2,17 @@ import React, { useState, useEffect, useRef } from 'react';
 import ReactMarkdown from 'react-markdown';
 import remarkGfm from 'remark-gfm';
 import Avatar from './Avatar';
+import fetchPage from '../fetchPage';
 
 const ChatInterface = ({ sessionId }) => {
   const [messages, setMessages] = useState([]);
   const [input, setInput] = useState('');
   const [avatarUrl, setAvatarUrl] = useState('http://localhost:8000/static/avatars/default.png');
   const [isLoading, setIsLoading] = useState(false);
+  const [messagesCursor, setMessagesCursor] = useState(null);
   const messagesEndRef = useRef(null);
+  // Set while older messages are prepended, so the view stays where the user is reading
+  const keepScrollRef = useRef(false);
   const [socket, setSocket] = useState(null);
 
   const scrollToBottom = () => {
@@ -16,6 +20,10 @@ const ChatInterface = ({ sessionId }) => {
   };
 
   useEffect(() => {
+    if (keepScrollRef.current) {
+      keepScrollRef.current = false;
+      return;
+    }
     scrollToBottom();
   }, [messages]);
 
@@ -25,12 +33,14 @@ const ChatInterface = ({ sessionId }) => {
     const fetchHistory = async () => {
       if (!sessionId) return;
       setMessages([]); // Clear previous messages
+      setMessagesCursor(null);
       try {
-        const response = await fetch(`http://localhost:8000/api/v1/sessions/${sessionId}/messages`);
-        if (response.ok) {
-          const data = await response.json();
-          setMessages(data.map(m => ({ sender: m.sender, text: m.content })));
-        }
+        // Latest page only, earlier messages are loaded on demand
+        const { items, nextCursor } = await fetchPage(
+          `http://localhost:8000/api/v1/sessions/${sessionId}/messages`
+        );
+        setMessages(items.map(m => ({ sender: m.sender, text: m.content })));
+        setMessagesCursor(nextCursor);
       } catch (error) {
         console.error("Error fetching history:", error);
       }
@@ -38,6 +48,22 @@ const ChatInterface = ({ sessionId }) => {
     fetchHistory();
   }, [sessionId]);
 
+  const loadEarlierMessages = async () => {
+    if (!messagesCursor) return;
+    try {
+      const { items, nextCursor } = await fetchPage(
+        `http://localhost:8000/api/v1/sessions/${sessionId}/messages`,
+        messagesCursor
+      );
+      keepScrollRef.current = true;
+      // Pages are chronological, so the older page goes in front
+      setMessages(prev => items.map(m => ({ sender: m.sender, text: m.content })).concat(prev));
+      setMessagesCursor(nextCursor);
+    } catch (error) {
+      console.error("Error fetching history:", error);
+    }
+  };
+
   useEffect(() => {
     if (!sessionId) return;
 
@@ -75,7 +101,7 @@ const ChatInterface = ({ sessionId }) => {
     setIsLoading(true);
 
     try {
-      const response = await fetch('http://localhost:8000/api/v1/chat', {
+      const response = await fetch('http://localhost:8000/api/v1/chat/stream', {
         method: 'POST',
         headers: {
           'Content-Type': 'application/json',
@@ -86,16 +112,55 @@ const ChatInterface = ({ sessionId }) => {
         }),
       });
 
-      const data = await response.json();
-
-      if (data.status === 'success') {
-        setMessages(prev => [...prev, { sender: 'bot', text: data.reply_text }]);
-        if (data.avatar_url) {
-          setAvatarUrl(data.avatar_url);
+      // Add an empty bot bubble and grow it as tokens arrive
+      setMessages(prev => [...prev, { sender: 'bot', text: '' }]);
+      const appendToReply = (text) => {
+        setMessages(prev => {
+          const updated = [...prev];
+          const last = updated[updated.length - 1];
+          updated[updated.length - 1] = { ...last, text: last.text + text };
+          return updated;
+        });
+      };
+      const replaceReply = (text) => {
+        setMessages(prev => [...prev.slice(0, -1), { sender: 'bot', text }]);
+      };
+
+      const reader = response.body.getReader();
+      const decoder = new TextDecoder();
+      let buffer = '';
+
+      while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+
+        // Server-Sent Events are separated by a blank line
+        let boundary;
+        while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+          const rawEvent = buffer.slice(0, boundary);
+          buffer = buffer.slice(boundary + 2);
+
+          let eventName = 'message';
+          let payload = '';
+          for (const line of rawEvent.split('\n')) {
+            if (line.startsWith('event: ')) eventName = line.slice(7);
+            else if (line.startsWith('data: ')) payload += line.slice(6);
+          }
+          if (!payload) continue;
+          const data = JSON.parse(payload);
+
+          if (eventName === 'token') {
+            setIsLoading(false);
+            appendToReply(data.text);
+          } else if (eventName === 'done') {
+            replaceReply(data.reply_text);
+            if (data.status === 'success' && data.avatar_url) {
+              setAvatarUrl(data.avatar_url);
+            }
+            // For 'generating_avatar' the WebSocket will handle the avatar update later
+          }
         }
-      } else if (data.status === 'generating_avatar') {
-         setMessages(prev => [...prev, { sender: 'bot', text: data.reply_text }]);
-         // WebSocket will handle the avatar update later
       }
 
     } catch (error) {
@@ -111,6 +176,13 @@ const ChatInterface = ({ sessionId }) => {
       <Avatar url={avatarUrl} />
       
       <div className="chat-window" style={{ flex: 1, overflowY: 'auto', border: '1px solid #ddd', padding: '10px', marginBottom: '10px', borderRadius: '5px' }}>
+        {messagesCursor && (
+          <div style={{ textAlign: 'center', margin: '5px 0' }}>
+            <button onClick={loadEarlierMessages} style={{ padding: '5px 10px', background: 'none', border: '1px solid #ddd', borderRadius: '5px', cursor: 'pointer' }}>
+              Load earlier messages
+            </button>
+          </div>
+        )}
         {messages.map((msg, index) => (
           <div key={index} style={{ textAlign: msg.sender === 'user' ? 'right' : 'left', margin: '5px 0' }}>
             <div style={{ 
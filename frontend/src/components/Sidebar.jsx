@@ -1,6 +1,6 @@
 import React from 'react';
 
-const Sidebar = ({ sessions, currentSessionId, onSelectSession, onNewSession, onDeleteSession }) => {
+const Sidebar = ({ sessions, currentSessionId, onSelectSession, onNewSession, onDeleteSession, hasMoreSessions, onLoadMoreSessions }) => {
   return (
     <div style={{ 
       width: '250px', 
@@ -70,6 +70,22 @@ const Sidebar = ({ sessions, currentSessionId, onSelectSession, onNewSession, on
             </button>
           </div>
         ))}
+        {hasMoreSessions && (
+          <button
+            onClick={onLoadMoreSessions}
+            style={{
+              width: '100%',
+              padding: '8px',
+              background: 'none',
+              border: '1px solid #ddd',
+              borderRadius: '5px',
+              cursor: 'pointer',
+              fontSize: '14px'
+            }}
+          >
+            Load older chats
+          </button>
+        )}
       </div>
     </div>
   );
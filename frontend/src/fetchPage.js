@@ -0,0 +1,14 @@
+// Loads one page of a paginated list endpoint. Pass the returned nextCursor back as
+// `before` to get the next (older) page; it is null once there are no more pages.
+const fetchPage = async (url, before = null) => {
+  const separator = url.includes('?') ? '&' : '?';
+  const pageUrl = before ? `${url}${separator}before=${encodeURIComponent(before)}` : url;
+  const response = await fetch(pageUrl);
+  if (!response.ok) {
+    throw new Error(`Request to ${pageUrl} failed with status ${response.status}`);
+  }
+  const items = await response.json();
+  return { items, nextCursor: response.headers.get('X-Next-Cursor') };
+};
+
+export default fetchPage;